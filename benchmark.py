@@ -0,0 +1,252 @@
+"""Benchmark degli handler del bot, eseguiti in-process con una Bot API finta.
+
+Per ogni dimensione richiesta crea un database temporaneo con N prenotazioni sintetiche,
+poi chiama direttamente gli handler di trash_bot.py con Update e CallbackQuery veri
+(costruiti da JSON) e un Bot che non usa la rete. Per ogni handler riporta i percentili
+di latenza, le query SQLite eseguite per update e la memoria allocata per update.
+
+Uso:
+    python benchmark.py --sizes 1000,100000,1000000 --iterations 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from telegram import Bot, Update
+from telegram.ext import ApplicationBuilder, CallbackContext
+from telegram.request import BaseRequest
+
+import trash_bot
+from cache import RenderCache
+from db import Database
+from schema import MIGRATIONS, rebuild_leaderboard
+
+BENCH_CHAT_ID = -1001
+BENCH_USER_ID = 1
+SEED_USERS = 200
+
+
+class FakeBotApiRequest(BaseRequest):
+    """Backend HTTP finto per ``telegram.Bot``: risponde subito con risultati plausibili."""
+
+    def __init__(self):
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "trashBot", "username": "trash_bot"}
+        elif endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {
+                "message_id": next(self._message_ids),
+                "date": 0,
+                "chat": {"id": int(params.get("chat_id", BENCH_CHAT_ID)), "type": "group"},
+                "text": params.get("text", ""),
+            }
+        elif endpoint == "getChatAdministrators":
+            result = [{"status": "creator", "user": _user(BENCH_USER_ID), "is_anonymous": False}]
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Utente{user_id}", "username": f"utente{user_id}"}
+
+
+_update_ids = itertools.count(1)
+
+
+def command_update(bot, text, user_id=BENCH_USER_ID):
+    command = text.split()[0]
+    return Update.de_json({
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": 0,
+            "chat": {"id": BENCH_CHAT_ID, "type": "group"},
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }, bot)
+
+
+def callback_update(bot, data, user_id=BENCH_USER_ID):
+    return Update.de_json({
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": BENCH_CHAT_ID, "type": "group"},
+                "from": _user(1),
+                "text": "-",
+            },
+        },
+    }, bot)
+
+
+def seed(conn, bookings):
+    """Inserisce ``bookings`` prenotazioni passate, metà spazzatura e metà caffè, più qualche futura."""
+    today = date.today()
+    conn.executemany('INSERT INTO users (user_id, user_name) VALUES (?, ?)',
+                     ((user_id, f"Utente{user_id} (@utente{user_id})") for user_id in range(1, SEED_USERS + 1)))
+    for table, count in (("trash_bookings", bookings - bookings // 2), ("coffee_bookings", bookings // 2)):
+        rows = (
+            (BENCH_CHAT_ID, (today - timedelta(days=1 + i // SEED_USERS)).isoformat(), 1 + i % SEED_USERS)
+            for i in range(count)
+        )
+        conn.executemany(f'INSERT INTO {table} (chat_id, booking_date, user_id) VALUES (?, ?, ?)', rows)
+        # Prenotazioni future dell'utente del benchmark, per la lista di cancellazione
+        conn.executemany(f'INSERT INTO {table} (chat_id, booking_date, user_id) VALUES (?, ?, ?)',
+                         ((BENCH_CHAT_ID, (today + timedelta(days=day)).isoformat(), BENCH_USER_ID) for day in range(1, 11)))
+    rebuild_leaderboard(conn, BENCH_CHAT_ID)
+
+
+def prepare_database(path, bookings):
+    database = Database(path)
+    database.open()
+    database.migrate(MIGRATIONS)
+    database.run_sync(seed, bookings)
+    database.run_sync(lambda conn: conn.execute("ANALYZE"))
+    database.close()
+
+
+def scenarios(bot):
+    """Coppie (nome, handler, fabbrica dell'update) da misurare."""
+    next_monday = date.today() + timedelta(days=7 - date.today().weekday())
+    booking_users = itertools.count(SEED_USERS + 1)
+    return [
+        ("book_command", trash_bot.book_command, lambda: command_update(bot, "/prenota")),
+        ("handle_booking", trash_bot.handle_booking,
+         lambda: callback_update(bot, f"book_trash_{next_monday.isoformat()}", user_id=next(booking_users))),
+        ("view_bookings", trash_bot.view_bookings, lambda: command_update(bot, "/visualizza")),
+        ("view_schedule", trash_bot.view_schedule, lambda: command_update(bot, "/calendario")),
+        ("cancel_booking_selection", trash_bot.cancel_booking_selection, lambda: callback_update(bot, "cancel_trash")),
+        ("leaderboard_command", trash_bot.leaderboard_command, lambda: command_update(bot, "/leaderboard")),
+    ]
+
+
+async def measure(application, name, handler, make_update, iterations, cold, queries):
+    latencies = []
+    query_counts = []
+    for _ in range(iterations):
+        update = make_update()
+        context = CallbackContext.from_update(update, application)
+        if cold:
+            trash_bot.rendered.invalidate()
+        before = queries[0]
+        start = time.perf_counter()
+        await handler(update, context)
+        latencies.append((time.perf_counter() - start) * 1000)
+        query_counts.append(queries[0] - before)
+
+    # Seconda passata con tracemalloc attivo: rallenta, quindi non entra nelle latenze
+    allocated = []
+    tracemalloc.start()
+    for _ in range(max(iterations // 10, 1)):
+        update = make_update()
+        context = CallbackContext.from_update(update, application)
+        if cold:
+            trash_bot.rendered.invalidate()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await handler(update, context)
+        allocated.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "handler": name,
+        "p50_ms": percentiles[49],
+        "p95_ms": percentiles[94],
+        "p99_ms": percentiles[98],
+        "queries": statistics.mean(query_counts),
+        "peak_kb": statistics.mean(allocated) / 1024,
+    }
+
+
+async def run_size(bookings, iterations, cold, workdir):
+    path = os.path.join(workdir, f"bench_{bookings}.db")
+    start = time.perf_counter()
+    prepare_database(path, bookings)
+    print(f"\n== {bookings} prenotazioni (database pronto in {time.perf_counter() - start:.1f}s) ==")
+
+    # Riapre il database del bot sul file appena creato, con cache vuote
+    trash_bot.db = Database(path)
+    trash_bot.rendered = RenderCache()
+    trash_bot.init_db()
+    queries = [0]
+
+    def count_statement(statement):
+        queries[0] += 1
+
+    await trash_bot.db.run(lambda conn: conn.set_trace_callback(count_statement))
+
+    bot = Bot("0:benchmark", request=FakeBotApiRequest(), get_updates_request=FakeBotApiRequest())
+    application = ApplicationBuilder().bot(bot).build()
+    await bot.initialize()
+    try:
+        results = [
+            await measure(application, name, handler, make_update, iterations, cold, queries)
+            for name, handler, make_update in scenarios(bot)
+        ]
+    finally:
+        await bot.shutdown()
+        trash_bot.db.close()
+
+    print(f"{'handler':<26}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'query':>8}{'KB':>9}")
+    for row in results:
+        print(f"{row['handler']:<26}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+              f"{row['queries']:>8.1f}{row['peak_kb']:>9.1f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+                        help="numero di prenotazioni sintetiche per ogni esecuzione, separati da virgola")
+    parser.add_argument("--iterations", type=int, default=200, help="chiamate misurate per handler")
+    parser.add_argument("--cold", action="store_true", help="svuota la cache dei messaggi prima di ogni chiamata")
+    parser.add_argument("--json", action="store_true", help="stampa anche i risultati in JSON")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    all_results = {}
+    with tempfile.TemporaryDirectory(prefix="trashbot-bench-") as workdir:
+        for size in sizes:
+            all_results[size] = asyncio.run(run_size(size, args.iterations, args.cold, workdir))
+    if args.json:
+        json.dump(all_results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Aggiornamento ritardato delle bacheche fisse (messaggi pinnati) delle chat.
+
+Ogni modifica alle prenotazioni di una chat chiama ``touch``: il primo tocco pianifica
+un aggiornamento dopo ``delay`` secondi e quelli successivi, finché è in attesa, vengono
+assorbiti. Una raffica di prenotazioni produce così una sola modifica del messaggio.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BoardDebouncer:
+    """Raggruppa le richieste di aggiornamento per chat entro una finestra di ``delay`` secondi."""
+
+    def __init__(self, delay, refresh):
+        self._delay = delay
+        self._refresh = refresh  # coroutine refresh(chat_id, *args)
+        self._pending = {}  # chat_id → (task in attesa, args)
+
+    def touch(self, chat_id, *args):
+        """Pianifica ``refresh(chat_id, *args)`` se non ce n'è già uno in attesa per la chat."""
+        if chat_id not in self._pending:
+            task = asyncio.get_running_loop().create_task(self._run(chat_id, args))
+            self._pending[chat_id] = (task, args)
+
+    async def _run(self, chat_id, args):
+        await asyncio.sleep(self._delay)
+        # Le modifiche arrivate da qui in poi pianificano un nuovo aggiornamento
+        del self._pending[chat_id]
+        await self._refresh_safely(chat_id, args)
+
+    async def _refresh_safely(self, chat_id, args):
+        try:
+            await self._refresh(chat_id, *args)
+        except Exception:
+            logger.exception("Aggiornamento della bacheca della chat %s non riuscito", chat_id)
+
+    async def flush(self):
+        """Esegue subito gli aggiornamenti in attesa (prima dello spegnimento)."""
+        pending, self._pending = self._pending, {}
+        for task, _ in pending.values():
+            task.cancel()
+        for chat_id, (_, args) in pending.items():
+            await self._refresh_safely(chat_id, args)
@@ -0,0 +1,168 @@
+"""Cache in memoria condivise da tutto il processo."""
+import time
+from collections import OrderedDict
+
+
+class ScheduleCache:
+    """Copia in memoria della tabella trash_schedule, per chat.
+
+    Il calendario cambia solo con /configura, quindi viene caricato all'avvio e
+    aggiornato da ``set``. Le chat mai configurate usano ``default``. La versione di
+    una chat aumenta a ogni sua modifica e permette a chi deriva dati dal calendario
+    (tastiere, messaggi) di accorgersi che è cambiato.
+    """
+
+    def __init__(self, default):
+        self._default = dict(default)
+        self._schedules = {}
+        self._versions = {}
+
+    def load(self, rows):
+        """Sostituisce il contenuto con le righe (chat_id, day_of_week, trash_types) lette dal database."""
+        self._schedules = {}
+        for chat_id, day_of_week, trash_types in rows:
+            self._schedules.setdefault(chat_id, {})[day_of_week] = trash_types
+        for chat_id in self._versions:
+            self._versions[chat_id] += 1
+
+    def version(self, chat_id):
+        return self._versions.get(chat_id, 0)
+
+    def get(self, chat_id, day_of_week):
+        return self._schedules.get(chat_id, self._default).get(day_of_week, "Nessuna raccolta")
+
+    def all(self, chat_id):
+        return dict(self._schedules.get(chat_id, self._default))
+
+    def set(self, chat_id, day_of_week, trash_types):
+        # Alla prima modifica la chat parte dal calendario predefinito
+        self._schedules.setdefault(chat_id, dict(self._default))[day_of_week] = trash_types
+        self._versions[chat_id] = self.version(chat_id) + 1
+
+
+class AdminCache:
+    """Insiemi di user_id amministratori per chat, validi per ``ttl`` secondi.
+
+    La scadenza copre i cambi di cui il bot non viene informato (gli update chat_member
+    arrivano solo se il bot stesso è amministratore del gruppo).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._admins = {}  # chat_id → (scadenza, insieme di user_id)
+
+    def get(self, chat_id):
+        entry = self._admins.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, chat_id, user_ids):
+        self._admins[chat_id] = (time.monotonic() + self.ttl, set(user_ids))
+
+    def update(self, chat_id, user_id, is_admin):
+        """Applica una promozione o rimozione alla voce in cache, se presente."""
+        chat_admins = self.get(chat_id)
+        if chat_admins is None:
+            return
+        if is_admin:
+            chat_admins.add(user_id)
+        else:
+            chat_admins.discard(user_id)
+
+
+class UserDirectory:
+    """Mappa in memoria user_id → nome visualizzato, specchio della tabella users."""
+
+    def __init__(self):
+        self._names = {}
+
+    def load(self, rows):
+        self._names = dict(rows)
+
+    def name(self, user_id):
+        return self._names.get(user_id, str(user_id))
+
+    def is_current(self, user_id, user_name):
+        return self._names.get(user_id) == user_name
+
+    def set(self, user_id, user_name):
+        self._names[user_id] = user_name
+
+
+class RenderCache:
+    """Messaggi già formattati, validi finché i dati da cui derivano non cambiano.
+
+    Ogni voce è legata a una chat e a una chiave costruita dal chiamante (es. comando e
+    data di oggi), combinate con la versione dei dati di quella chat e con una versione
+    globale. ``invalidate(chat_id)`` è chiamato a ogni prenotazione, cancellazione o
+    modifica del calendario della chat, ``invalidate()`` quando cambia qualcosa visibile
+    in tutte le chat (es. il nome di un utente): una voce calcolata su dati vecchi non
+    può quindi più essere restituita, anche se la modifica avviene durante il rendering.
+    """
+
+    def __init__(self, max_entries=512):
+        self.version = 0
+        self.max_entries = max_entries
+        self._chat_versions = {}
+        self._entries = OrderedDict()
+
+    def _versioned_key(self, chat_id, key):
+        return (chat_id, key, self.version, self._chat_versions.get(chat_id, 0))
+
+    def invalidate(self, chat_id=None):
+        if chat_id is None:
+            self.version += 1
+            self._entries.clear()
+        else:
+            # Le voci vecchie della chat non sono più raggiungibili e usciranno dall'LRU
+            self._chat_versions[chat_id] = self._chat_versions.get(chat_id, 0) + 1
+
+    async def get_or_render(self, chat_id, key, render, *args):
+        """Restituisce il messaggio per ``key`` nella chat, chiamando ``await render(*args)`` se manca."""
+        versioned_key = self._versioned_key(chat_id, key)
+        message = self._entries.get(versioned_key)
+        if message is not None:
+            self._entries.move_to_end(versioned_key)
+            return message
+        
+        message = await render(*args)
+        if versioned_key == self._versioned_key(chat_id, key):
+            self._entries[versioned_key] = message
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return message
+
+
+class KeyboardCache:
+    """Tastiere inline costruite una volta per giorno, chat e versione del calendario.
+
+    ``builders`` associa a ogni tipo di tastiera una funzione ``build(chat_id, today)``;
+    al cambio di data tutte le tastiere precedenti vengono scartate.
+    """
+
+    def __init__(self, builders):
+        self._builders = builders
+        self._today = None
+        self._keyboards = {}
+
+    def get(self, kind, chat_id, today, schedule_version):
+        if today != self._today:
+            self._today = today
+            self._keyboards = {}
+        cached = self._keyboards.get((kind, chat_id))
+        if cached is not None and cached[0] == schedule_version:
+            return cached[1]
+        keyboard = self._builders[kind](chat_id, today)
+        self._keyboards[(kind, chat_id)] = (schedule_version, keyboard)
+        return keyboard
+
+    def warm(self, today, schedule_version, chat_ids=()):
+        """Ricostruisce per la data indicata le tastiere delle chat già servite e di ``chat_ids``.
+
+        ``schedule_version`` è una funzione ``chat_id -> versione``.
+        """
+        chats = {(kind, chat_id) for kind, chat_id in self._keyboards}
+        chats.update((kind, chat_id) for kind in self._builders for chat_id in chat_ids)
+        for kind, chat_id in chats:
+            self.get(kind, chat_id, today, schedule_version(chat_id))
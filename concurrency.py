@@ -0,0 +1,69 @@
+"""Elaborazione concorrente degli update con ordine garantito per utente all'interno di ogni chat."""
+import asyncio
+import sys
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Elabora in parallelo gli update di utenti o chat diversi, ma in sequenza e in ordine
+    di arrivo quelli dello stesso utente nella stessa chat.
+
+    La chiave è (chat, utente), la stessa delle ConversationHandler: ognuna continua a
+    vedere i propri update uno alla volta come con l'elaborazione sequenziale, mentre un
+    ``get_chat_administrators`` lento per un amministratore non blocca i bottoni degli
+    altri utenti del gruppo, e le prenotazioni di più persone dello stesso gruppo possono
+    finire nello stesso commit di ``Database.batched``. Gli update senza utente (o senza
+    chat) sono serializzati sulla sola chat (o sul solo utente).
+
+    Il limite di ``max_concurrent_updates`` vale solo per gli update che hanno già il lock
+    della propria chiave: quelli in coda dietro a una chiave occupata non tengono posti liberi.
+    Il semaforo di ``BaseUpdateProcessor``, preso prima di ``do_process_update``, è quindi
+    lasciato senza limite.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates deve essere un intero positivo")
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # chiave → [lock, update in attesa o in corso]; la voce sparisce quando non serve più
+        self._locks = {}
+
+    @staticmethod
+    def _serialization_key(update):
+        if isinstance(update, Update):
+            chat, user = update.effective_chat, update.effective_user
+            if chat is not None and user is not None:
+                return (chat.id, user.id)
+            if chat is not None:
+                return chat.id
+            if user is not None:
+                return ("user", user.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._serialization_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
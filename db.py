@@ -0,0 +1,232 @@
+"""Livello di accesso al database SQLite del bot.
+
+Una sola connessione a lunga durata vive su un thread dedicato: tutte le query
+vengono eseguite lì e gli handler le attendono con ``await`` senza bloccare
+l'event loop di python-telegram-bot.
+"""
+import asyncio
+import logging
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# PRAGMA applicati all'apertura della connessione
+PRAGMAS = (
+    "PRAGMA auto_vacuum = INCREMENTAL",  # Vale per i database nuovi; quelli esistenti con Database.vacuum()
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",  # Sicuro con WAL, evita un fsync per ogni commit
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # ~16 MB di page cache
+    "PRAGMA mmap_size = 67108864",  # 64 MB
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+)
+
+
+def apply_migrations(conn, migrations):
+    """Porta lo schema all'ultima versione usando ``PRAGMA user_version``.
+
+    ``migrations`` è una lista di funzioni ``fn(conn)``: la migrazione in posizione
+    ``i`` porta lo schema alla versione ``i + 1``. Ciascuna gira in una propria
+    transazione insieme all'aggiornamento della versione.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in enumerate(migrations[version:], start=version + 1):
+        logger.info("Migrazione dello schema alla versione %d (%s)", target, migration.__name__)
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    return max(version, len(migrations))
+
+
+def _caller():
+    """Nome della funzione che ha chiesto l'operazione, saltando questo modulo e le lambda."""
+    frame = sys._getframe(2)
+    while frame.f_back is not None and (frame.f_code.co_filename == __file__ or frame.f_code.co_name.startswith("<")):
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+
+class Database:
+    """Connessione SQLite persistente servita da un thread dedicato.
+
+    Se ``on_query`` è indicato viene chiamato sul thread del database dopo ogni
+    operazione come ``on_query(chiamante, operazione, secondi)``, dove l'operazione
+    è il testo SQL o il nome della funzione eseguita.
+
+    ``batch_window`` è l'attesa in secondi con cui ``batched`` raccoglie le scritture
+    concorrenti prima di eseguirle in un'unica transazione.
+    """
+
+    def __init__(self, path, on_query=None, batch_window=0.002):
+        self.path = path
+        self.on_query = on_query
+        self.batch_window = batch_window
+        self._conn = None
+        self._executor = None
+        self._batch = []  # (fn, args, future, chiamante) in attesa del prossimo commit
+        self._batch_task = None
+
+    # Gestione del ciclo di vita
+    def open(self):
+        """Apre la connessione sul thread del database (idempotente)."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trashbot-db")
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        if self._conn is not None:
+            return
+        # Il modulo sqlite3 mantiene una cache degli statement preparati per connessione
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        self._conn = conn
+        logger.info("Database %s aperto", self.path)
+
+    def close(self):
+        """Chiude la connessione e ferma il thread del database."""
+        if self._executor is None:
+            return
+        self._executor.submit(self._disconnect).result()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def _disconnect(self):
+        if self._conn is not None:
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
+            self._conn = None
+
+    def migrate(self, migrations):
+        """Applica le migrazioni mancanti e restituisce la versione dello schema."""
+        return self._executor.submit(self._invoke, apply_migrations, (migrations,)).result()
+
+    async def vacuum(self):
+        """Restituisce al filesystem le pagine libere del file.
+
+        Con ``auto_vacuum = INCREMENTAL`` basta un ``incremental_vacuum``; un database creato
+        senza viene convertito una volta sola con un ``VACUUM`` completo.
+        """
+        def vacuum(conn):
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("Conversione di %s ad auto_vacuum incrementale", self.path)
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # executescript avanza lo statement fino in fondo: con execute() verrebbe liberata una sola pagina
+                conn.executescript("PRAGMA incremental_vacuum;")
+            # In WAL il file principale si accorcia solo al checkpoint
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        await self.run(vacuum)
+
+    # Esecuzione sul thread del database
+    def _invoke(self, fn, args):
+        return fn(self._conn, *args)
+
+    def _in_transaction(self, fn, args):
+        with self._conn:
+            return fn(self._conn, *args)
+
+    def _observed(self, call, fn, args, caller, operation):
+        start = time.perf_counter()
+        try:
+            return call(fn, args)
+        finally:
+            self.on_query(caller, operation or fn.__name__, time.perf_counter() - start)
+
+    def _submit(self, call, fn, args, operation=None):
+        if self.on_query is None:
+            return self._executor.submit(call, fn, args)
+        return self._executor.submit(self._observed, call, fn, args, _caller(), operation)
+
+    def run_sync(self, fn, *args):
+        """Esegue ``fn(conn, *args)`` in una transazione e attende il risultato (fuori dall'event loop)."""
+        return self._submit(self._in_transaction, fn, args).result()
+
+    async def run(self, fn, *args, operation=None):
+        """Esegue ``fn(conn, *args)`` sul thread del database senza transazione esplicita."""
+        return await asyncio.wrap_future(self._submit(self._invoke, fn, args, operation))
+
+    async def transaction(self, fn, *args, operation=None):
+        """Esegue ``fn(conn, *args)`` in un'unica transazione (commit o rollback automatico)."""
+        return await asyncio.wrap_future(self._submit(self._in_transaction, fn, args, operation))
+
+    async def batched(self, fn, *args):
+        """Come ``transaction``, ma le chiamate concorrenti condividono un'unica transazione.
+
+        Le chiamate arrivate entro ``batch_window`` dalla prima vengono eseguite in ordine,
+        ciascuna in un proprio SAVEPOINT, con un solo commit: ogni chiamante riceve il
+        proprio risultato o la propria eccezione, senza annullare le scritture degli altri.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((fn, args, future, _caller() if self.on_query else None))
+        if self._batch_task is None:
+            self._batch_task = loop.create_task(self._commit_batch())
+        return await future
+
+    async def _commit_batch(self):
+        await asyncio.sleep(self.batch_window)
+        batch, self._batch = self._batch, []
+        self._batch_task = None
+        loop = asyncio.get_running_loop()
+        try:
+            outcomes = await loop.run_in_executor(self._executor, self._run_batch, batch)
+        except BaseException as error:
+            # Commit fallito: nessuna scrittura del gruppo è stata salvata
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            if not isinstance(error, Exception):
+                raise
+            return
+        for (_, _, future, _), (ok, value) in zip(batch, outcomes):
+            if future.done():
+                continue  # Chiamante annullato nel frattempo
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _run_batch(self, batch):
+        conn = self._conn
+        outcomes = []
+        conn.execute("BEGIN")
+        try:
+            for fn, args, _, caller in batch:
+                start = time.perf_counter()
+                conn.execute("SAVEPOINT batched")
+                try:
+                    outcomes.append((True, fn(conn, *args)))
+                except Exception as error:
+                    conn.execute("ROLLBACK TO batched")
+                    outcomes.append((False, error))
+                conn.execute("RELEASE batched")
+                if caller is not None:
+                    self.on_query(caller, fn.__name__, time.perf_counter() - start)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        return outcomes
+
+    # Scorciatoie per le query più comuni
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), operation=sql)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), operation=sql)
+
+    async def execute(self, sql, params=()):
+        """Esegue uno statement di scrittura e restituisce il numero di righe modificate."""
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount, operation=sql)
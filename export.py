@@ -0,0 +1,98 @@
+"""Esportazione delle prenotazioni di una chat in CSV o NDJSON, eventualmente compressa.
+
+Le righe vengono lette a blocchi con paginazione keyset e scritte via via in un file
+temporaneo: la memoria usata non dipende dal numero di prenotazioni.
+"""
+import csv
+import gzip
+import io
+import json
+import tempfile
+from datetime import date
+
+# Righe lette dal database per ogni query
+EXPORT_CHUNK = 1000
+
+EXPORT_TYPES = {
+    "spazzatura": "trash_bookings",
+    "caffe": "coffee_bookings",
+}
+
+EXPORT_FIELDS = ("tipo", "data", "user_id", "utente")
+
+
+def parse_export_args(args):
+    """Interpreta ``[csv|ndjson] [gz] [spazzatura|caffe] [dal AAAA-MM-GG] [al AAAA-MM-GG]``.
+
+    Restituisce (formato, compresso, tipi, dal, al); solleva ValueError se un argomento non è valido.
+    """
+    export_format, compress, types, start, end = "csv", False, list(EXPORT_TYPES), None, None
+    tokens = iter(arg.lower() for arg in args)
+    for token in tokens:
+        if token in ("csv", "ndjson"):
+            export_format = token
+        elif token in ("gz", "gzip"):
+            compress = True
+        elif token in EXPORT_TYPES:
+            types = [token]
+        elif token in ("dal", "al"):
+            value = next(tokens, None)
+            if value is None:
+                raise ValueError(f"manca la data dopo '{token}'")
+            try:
+                day = date.fromisoformat(value).isoformat()
+            except ValueError:
+                raise ValueError(f"data non valida: {value}") from None
+            if token == "dal":
+                start = day
+            else:
+                end = day
+        else:
+            raise ValueError(f"opzione sconosciuta: {token}")
+    return export_format, compress, types, start, end
+
+
+async def iter_bookings(db, chat_id, types, start=None, end=None):
+    """Genera (tipo, data, user_id) delle prenotazioni della chat, per tipo e in ordine di data.
+
+    Ogni blocco riparte dall'ultima (data, utente) letta sull'indice (chat_id, booking_date, user_id).
+    """
+    for booking_type in types:
+        table = EXPORT_TYPES[booking_type]
+        last = (start or "", -1)
+        while True:
+            rows = await db.fetchall(f'''
+                SELECT booking_date, user_id FROM {table}
+                WHERE chat_id = ? AND (booking_date, user_id) > (?, ?) AND booking_date <= ?
+                ORDER BY booking_date, user_id
+                LIMIT ?
+            ''', (chat_id, *last, end or "9999-12-31", EXPORT_CHUNK))
+            for booking_date, user_id in rows:
+                yield booking_type, booking_date, user_id
+            if len(rows) < EXPORT_CHUNK:
+                break
+            last = rows[-1]
+
+
+async def write_export(rows, export_format, compress, user_name):
+    """Scrive le righe in un file temporaneo e restituisce (file riavvolto, numero di righe)."""
+    raw = tempfile.TemporaryFile()
+    binary = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+    text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    if export_format == "csv":
+        writer.writerow(EXPORT_FIELDS)
+    count = 0
+    async for booking_type, booking_date, user_id in rows:
+        record = (booking_type, booking_date, user_id, user_name(user_id))
+        if export_format == "csv":
+            writer.writerow(record)
+        else:
+            text.write(json.dumps(dict(zip(EXPORT_FIELDS, record)), ensure_ascii=False) + "\n")
+        count += 1
+    text.flush()
+    text.detach()
+    if compress:
+        binary.close()  # Scrive la coda gzip, lasciando aperto il file sottostante
+    raw.seek(0)
+    return raw, count
@@ -0,0 +1,329 @@
+"""Bot API di Telegram finta, locale, per i test end-to-end e di carico del bot.
+
+Il server risponde ai metodi usati da trash_bot.py, registra ogni chiamata in uscita
+(sendMessage, editMessageText, answerCallbackQuery, ...) e consegna gli update iniettati
+sia con getUpdates (polling) sia con POST al webhook registrato con setWebhook.
+
+Eseguito come script avvia il server, lancia ``trash_bot.py`` con ``main()`` puntato su
+di esso (TELEGRAM_API_BASE_URL), inietta raffiche di comandi e pressioni di bottoni da
+migliaia di utenti sintetici e misura update/s e latenza di risposta end-to-end:
+
+    python fake_bot_api.py --users 2000 --groups 20
+    python fake_bot_api.py --users 2000 --groups 20 --webhook
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import queue
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "trashBot", "username": "trash_bot"}
+
+# Metodi che rispondono a un update: la prima chiamata chiude la misura di latenza
+MESSAGE_METHODS = ("sendMessage", "editMessageText", "sendDocument")
+
+
+def synthetic_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Utente{user_id}", "username": f"utente{user_id}"}
+
+
+class FakeBotApi:
+    """Server HTTP che imita la Bot API per un solo bot."""
+
+    def __init__(self, host="127.0.0.1", port=0, push_workers=8):
+        self._updates = []  # update in attesa di getUpdates
+        self._next_update_id = itertools.count(1)
+        self._next_message_id = itertools.count(1_000_000)
+        self._condition = threading.Condition()
+        self.calls = []  # (istante, metodo, parametri)
+        self.webhook = None  # (url, secret_token) dopo setWebhook
+        self.ready = threading.Event()  # il bot ha iniziato a ricevere update
+        self.admins = {}  # chat_id → user_id del creatore del gruppo
+        self._pending = {}  # chiave di risposta → istante di iniezione
+        self.latencies = []
+        self._push_queues = [queue.Queue() for _ in range(push_workers)]
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True).start()
+        for push_queue in self._push_queues:
+            threading.Thread(target=self._push_worker, args=(push_queue,), daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._condition:
+            self._condition.notify_all()
+
+    # Iniezione degli update
+    def inject_command(self, chat_id, user_id, text):
+        message_id = next(self._next_message_id)
+        command = text.split()[0]
+        self._inject(("message", chat_id, message_id), {
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private", "title": f"Gruppo {chat_id}"},
+                "from": synthetic_user(user_id),
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        })
+
+    def inject_callback(self, chat_id, user_id, data):
+        callback_id = str(next(self._next_message_id))
+        self._inject(("callback", callback_id), {
+            "callback_query": {
+                "id": callback_id,
+                "from": synthetic_user(user_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self._next_message_id),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                    "from": BOT_USER,
+                    "text": "-",
+                },
+            },
+        })
+
+    def _inject(self, response_key, payload):
+        update = {"update_id": next(self._next_update_id), **payload}
+        with self._condition:
+            self._pending[response_key] = time.perf_counter()
+            if self.webhook:
+                chat_id = (payload.get("message") or payload["callback_query"]["message"])["chat"]["id"]
+                # Gli update della stessa chat passano sempre dallo stesso worker, in ordine
+                self._push_queues[hash(chat_id) % len(self._push_queues)].put(update)
+            else:
+                self._updates.append(update)
+                self._condition.notify_all()
+
+    def wait_for_responses(self, timeout):
+        """Attende che ogni update iniettato abbia ricevuto una risposta; restituisce quelli rimasti."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._pending and time.monotonic() < deadline:
+                self._condition.wait(0.05)
+            return len(self._pending)
+
+    def _push_worker(self, push_queue):
+        connection = None
+        while True:
+            update = push_queue.get()
+            url, secret = self.webhook
+            parts = urlsplit(url)
+            body = json.dumps(update).encode()
+            headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret or ""}
+            for _ in range(2):  # un secondo tentativo se la connessione keep-alive è stata chiusa
+                try:
+                    if connection is None:
+                        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+                    connection.request("POST", parts.path or "/", body, headers)
+                    connection.getresponse().read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    connection = None
+
+    # Metodi della Bot API
+    def _record_response(self, method, params):
+        if method == "answerCallbackQuery":
+            key = ("callback", params.get("callback_query_id"))
+        elif method in MESSAGE_METHODS and params.get("reply_parameters"):
+            reply = json.loads(params["reply_parameters"])
+            key = ("message", int(params["chat_id"]), reply["message_id"])
+        else:
+            return
+        with self._condition:
+            injected_at = self._pending.pop(key, None)
+            if injected_at is not None:
+                self.latencies.append(time.perf_counter() - injected_at)
+                self._condition.notify_all()
+
+    def call(self, method, params):
+        self.calls.append((time.perf_counter(), method, params))
+        self._record_response(method, params)
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "setWebhook":
+            self.webhook = (params["url"], params.get("secret_token"))
+            self.ready.set()
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": next(self._next_message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method == "getChatAdministrators":
+            creator = self.admins.get(int(params["chat_id"]), 0)
+            return [{"status": "creator", "user": synthetic_user(creator), "is_anonymous": False}]
+        if method == "getChatMember":
+            return {"status": "member", "user": synthetic_user(int(params["user_id"]))}
+        if method == "getMyCommands":
+            return []
+        return True
+
+    def _get_updates(self, params):
+        self.ready.set()
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        deadline = time.monotonic() + float(params.get("timeout", 0))
+        with self._condition:
+            # Scarta gli update già confermati dal bot con offset
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Intestazioni e corpo partono in due send: con keep-alive, Nagle e l'ACK ritardato
+            # del client aggiungerebbero ~40 ms a ogni chiamata, misurando il finto server invece del bot
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                method = self.path.rsplit("/", 1)[-1]
+                result = api.call(method, self._parse(body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _parse(self, body):
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    return json.loads(body or b"{}")
+                if content_type.startswith("multipart/form-data"):
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+                    return {
+                        part.get_param("name", header="content-disposition"): part.get_content()
+                        for part in message.iter_parts()
+                        if part.get_filename() is None
+                    }
+                return dict(parse_qsl(body.decode()))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def run_load_test(args):
+    api = FakeBotApi(push_workers=args.push_workers).start()
+    workdir = tempfile.mkdtemp(prefix="trashbot-e2e-")
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN="0:fake",
+        TELEGRAM_API_BASE_URL=api.base_url,
+        TRASH_BOT_DB=os.path.join(workdir, "trash_scheduler.db"),
+    )
+    if not args.telegram_limits:
+        # La Bot API finta non ha flood limit: senza limiti si misura il bot, non l'attesa in coda
+        env.update(SEND_RATE_PER_SECOND="0", SEND_RATE_PER_GROUP_PER_MINUTE="0")
+    if args.webhook:
+        env.update(WEBHOOK_URL=f"http://127.0.0.1:{args.webhook_port}", WEBHOOK_LISTEN="127.0.0.1",
+                   WEBHOOK_PORT=str(args.webhook_port), WEBHOOK_PATH="telegram")
+    bot = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "trash_bot.py")],
+                           env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if args.quiet else None)
+    try:
+        if not api.ready.wait(30):
+            raise SystemExit("Il bot non si è collegato alla Bot API finta entro 30 secondi")
+        time.sleep(0.5)  # lascia al server webhook il tempo di mettersi in ascolto
+
+        groups = [-(100_000 + index) for index in range(args.groups)]
+        members = {chat_id: [] for chat_id in groups}
+        for user_id in range(2, args.users + 2):
+            members[groups[user_id % len(groups)]].append(user_id)
+        for chat_id, user_ids in members.items():
+            api.admins[chat_id] = user_ids[0] if user_ids else 0
+        next_monday = date.today() + timedelta(days=7 - date.today().weekday())
+
+        # Raffica: ogni utente apre /prenota, preme un giorno e poi guarda /visualizza
+        start = time.perf_counter()
+        injected = 0
+        for user_id in range(2, args.users + 2):
+            chat_id = groups[user_id % len(groups)]
+            booking_date = next_monday + timedelta(days=user_id % 5)
+            api.inject_command(chat_id, user_id, "/prenota")
+            api.inject_callback(chat_id, user_id, f"book_trash_{booking_date.isoformat()}")
+            api.inject_command(chat_id, user_id, "/visualizza")
+            injected += 3
+        missing = api.wait_for_responses(args.timeout)
+        elapsed = time.perf_counter() - start
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(15)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+
+    latencies = sorted(latency * 1000 for latency in api.latencies)
+    answered = injected - missing
+    print(f"modalità: {'webhook' if args.webhook else 'polling'}, utenti: {args.users}, gruppi: {args.groups}")
+    print(f"update iniettati: {injected}, con risposta: {answered}, tempo: {elapsed:.2f}s, "
+          f"throughput: {answered / elapsed:.1f} update/s")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        print(f"latenza prima risposta: p50 {percentiles[49]:.1f} ms, p95 {percentiles[94]:.1f} ms, "
+              f"p99 {percentiles[98]:.1f} ms, max {latencies[-1]:.1f} ms")
+    methods = {}
+    for _, method, _ in api.calls:
+        methods[method] = methods.get(method, 0) + 1
+    print("chiamate alla Bot API:", ", ".join(f"{method}={count}" for method, count in sorted(methods.items())))
+    return 0 if missing == 0 else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico end-to-end contro una Bot API locale finta.")
+    parser.add_argument("--users", type=int, default=1000, help="utenti sintetici")
+    parser.add_argument("--groups", type=int, default=10, help="gruppi tra cui distribuire gli utenti")
+    parser.add_argument("--webhook", action="store_true", help="consegna gli update via webhook invece che con getUpdates")
+    parser.add_argument("--webhook-port", type=int, default=8444)
+    parser.add_argument("--push-workers", type=int, default=8, help="connessioni parallele verso il webhook")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="mantiene i limiti di invio del bot (30 msg/s, 20 msg/min per gruppo)")
+    parser.add_argument("--timeout", type=float, default=120, help="secondi di attesa per le risposte")
+    parser.add_argument("--quiet", action="store_true", help="nasconde il log del bot")
+    sys.exit(run_load_test(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Importazione in blocco di prenotazioni passate e del calendario della raccolta.
+
+Accetta CSV, JSON (lista di oggetti) o NDJSON, anche compressi con gzip. Le prenotazioni
+usano le stesse colonne di /esporta (tipo, data, user_id, utente), quindi un file
+esportato si reimporta così com'è. Il calendario ha le colonne giorno e tipi, oppure è
+un oggetto JSON {"Lunedì": "Carta", ...}.
+
+L'intero file viene validato prima di scrivere qualsiasi cosa; poi le righe vengono
+caricate con executemany in transazioni da IMPORT_CHUNK righe, con gli indici secondari
+delle prenotazioni ricostruiti una sola volta alla fine. I riepiloghi settimanali usati da
+/statistiche vengono aggiornati nella stessa transazione di ogni blocco. Conviene eseguirlo a bot fermo:
+il calendario in memoria di un bot in esecuzione si aggiorna solo al riavvio.
+
+Uso:
+    python importer.py prenotazioni storico.csv --chat-id -1001234567890
+    python importer.py calendario calendario.json --chat-id -1001234567890
+"""
+import argparse
+import csv
+import gzip
+import json
+import sys
+import time
+from datetime import date
+
+import trash_bot
+from export import EXPORT_TYPES
+from schema import LEADERBOARD_COUNTERS, MIGRATIONS, rebuild_leaderboard
+from stats import count_bookings_from
+
+# Righe scritte in ogni transazione
+IMPORT_CHUNK = 5000
+
+# Errori mostrati prima di interrompere l'importazione
+MAX_REPORTED_ERRORS = 20
+
+BOOKING_TYPES = {**EXPORT_TYPES, "trash": "trash_bookings", "coffee": "coffee_bookings"}
+
+DAY_INDEXES = {
+    **{name.lower(): index for index, name in enumerate(trash_bot.GIORNI_NOMI)},
+    **trash_bot.GIORNI,
+    **{str(index): index for index in range(len(trash_bot.GIORNI_NOMI))},
+}
+
+
+class InvalidFile(Exception):
+    """File non valido: ``errors`` contiene i messaggi per riga."""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} righe non valide")
+        self.errors = errors
+
+
+def read_records(path):
+    """Legge il file come sequenza di (numero di riga, dizionario), scegliendo il formato dall'estensione."""
+    name = path.lower()
+    opener = gzip.open if name.endswith(".gz") else open
+    name = name.removesuffix(".gz")
+    with opener(path, "rt", encoding="utf-8", newline="") as handle:
+        if name.endswith(".csv"):
+            # La riga 1 è l'intestazione
+            yield from enumerate(csv.DictReader(handle), start=2)
+        elif name.endswith((".ndjson", ".jsonl")):
+            for line_number, line in enumerate(handle, start=1):
+                if line.strip():
+                    yield line_number, json.loads(line)
+        elif name.endswith(".json"):
+            data = json.load(handle)
+            if isinstance(data, dict):
+                data = [{"giorno": day, "tipi": types} for day, types in data.items()]
+            yield from enumerate(data, start=1)
+        else:
+            raise ValueError(f"formato non riconosciuto: {path} (usa .csv, .json o .ndjson, anche .gz)")
+
+
+def _validate(records, parse_record):
+    rows, errors = [], []
+    for line_number, record in records:
+        try:
+            rows.append(parse_record(record))
+        except (KeyError, TypeError, ValueError) as error:
+            errors.append(f"riga {line_number}: {error!r}")
+            if len(errors) >= MAX_REPORTED_ERRORS:
+                break
+    if errors:
+        raise InvalidFile(errors)
+    return rows
+
+
+def parse_booking(record):
+    """(tabella, data ISO, user_id, nome o None) da una riga di prenotazione."""
+    booking_type = str(record["tipo"]).strip().lower()
+    if booking_type not in BOOKING_TYPES:
+        raise ValueError(f"tipo sconosciuto: {record['tipo']}")
+    table = BOOKING_TYPES[booking_type]
+    booking_date = date.fromisoformat(str(record["data"]).strip()).isoformat()
+    user_id = int(record["user_id"])
+    user_name = (record.get("utente") or "").strip() or None
+    return table, booking_date, user_id, user_name
+
+
+def parse_schedule(record):
+    """(giorno 0-4, tipi) da una riga del calendario."""
+    day = str(record["giorno"]).strip().lower()
+    if day not in DAY_INDEXES:
+        raise ValueError(f"giorno sconosciuto: {record['giorno']}")
+    trash_types = str(record["tipi"]).strip()
+    if not trash_types:
+        raise ValueError("tipi di rifiuti vuoti")
+    return DAY_INDEXES[day], trash_types
+
+
+def _tables_in(rows):
+    return sorted({table for table, *_ in rows})
+
+
+def _chunks(rows):
+    for start in range(0, len(rows), IMPORT_CHUNK):
+        yield rows[start:start + IMPORT_CHUNK]
+
+
+def _insert_bookings(conn, chat_id, chunk):
+    # I nomi del file servono solo per gli utenti che il bot non conosce ancora: quelli già
+    # presenti sono più recenti, e il bot li aggiorna comunque alla prossima interazione
+    names = {}
+    for _, _, user_id, user_name in chunk:
+        if user_name or user_id not in names:
+            names[user_id] = user_name or str(user_id)
+    conn.executemany('INSERT OR IGNORE INTO users (user_id, user_name) VALUES (?, ?)', names.items())
+    # Le righe passano da una tabella temporanea: così si contano nei riepiloghi settimanali
+    # solo le prenotazioni davvero nuove, con poche query aggregate per blocco
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS import_rows (
+            tbl TEXT NOT NULL,
+            booking_date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (tbl, booking_date, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('DELETE FROM temp.import_rows')
+    conn.executemany('INSERT OR IGNORE INTO temp.import_rows (tbl, booking_date, user_id) VALUES (?, ?, ?)',
+                     ((table, booking_date, user_id) for table, booking_date, user_id, _ in chunk))
+    inserted = 0
+    for table in _tables_in(chunk):
+        conn.execute(f'''
+            DELETE FROM temp.import_rows WHERE tbl = ? AND EXISTS (
+                SELECT 1 FROM {table} b
+                WHERE b.chat_id = ? AND b.booking_date = import_rows.booking_date AND b.user_id = import_rows.user_id
+            )
+        ''', (table, chat_id))
+        count_bookings_from(conn, LEADERBOARD_COUNTERS[table], chat_id, "temp.import_rows", "tbl = ?", (table,))
+        cursor = conn.execute(f'''
+            INSERT INTO {table} (chat_id, booking_date, user_id)
+            SELECT ?, booking_date, user_id FROM temp.import_rows WHERE tbl = ?
+        ''', (chat_id, table))
+        inserted += cursor.rowcount
+    return inserted
+
+
+def _drop_secondary_indexes(conn, tables):
+    """Elimina gli indici non univoci delle tabelle e ne restituisce le definizioni."""
+    rows = conn.execute(f'''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'
+        AND tbl_name IN ({", ".join("?" * len(tables))})
+    ''', tables).fetchall()
+    for name, _ in rows:
+        conn.execute(f'DROP INDEX {name}')
+    return [sql for _, sql in rows]
+
+
+def _recreate_indexes(conn, definitions):
+    for sql in definitions:
+        conn.execute(sql)
+
+
+def _archived(conn, chat_id):
+    """(data limite dell'archiviazione o None, mesi della chat già riassunti in monthly_bookings)."""
+    row = conn.execute("SELECT value FROM bot_state WHERE key = 'archive_cutoff'").fetchone()
+    months = {month for month, in conn.execute('SELECT DISTINCT month FROM monthly_bookings WHERE chat_id = ?', (chat_id,))}
+    return (row[0] if row else None), months
+
+
+def split_archived(db, chat_id, rows):
+    """Separa le righe già riassunte dall'archiviazione notturna da quelle da caricare.
+
+    Le prenotazioni archiviate non sono più riga per riga: reinserirle le conterebbe due
+    volte nella classifica e nelle statistiche. Si scartano quelle precedenti alla data
+    limite in un mese che la chat ha nei riepiloghi mensili (senza data limite registrata,
+    da un archivio precedente, basta il mese).
+    Restituisce (righe da caricare, righe scartate).
+    """
+    cutoff, months = db.run_sync(_archived, chat_id)
+    kept, skipped = [], []
+    for row in rows:
+        booking_date = row[1]
+        archived = booking_date[:7] in months and (cutoff is None or booking_date < cutoff)
+        (skipped if archived else kept).append(row)
+    return kept, skipped
+
+
+def import_bookings(db, chat_id, rows):
+    """Carica le prenotazioni, aggiornando i riepiloghi settimanali, e ricalcola la classifica della chat.
+
+    Le righe già archiviate vengono scartate (vedi ``split_archived``).
+    Restituisce (righe nuove, righe scartate perché archiviate).
+    """
+    rows, skipped = split_archived(db, chat_id, rows)
+    if not rows:
+        return 0, len(skipped)
+    tables = _tables_in(rows)
+    # Le prenotazioni duplicate sono scartate dall'indice univoco, che resta; gli altri si ricostruiscono alla fine
+    definitions = db.run_sync(_drop_secondary_indexes, tables)
+    inserted = 0
+    try:
+        for chunk in _chunks(rows):
+            inserted += db.run_sync(_insert_bookings, chat_id, chunk)
+    finally:
+        db.run_sync(_recreate_indexes, definitions)
+    db.run_sync(rebuild_leaderboard, chat_id)
+    db.run_sync(lambda conn: conn.execute("ANALYZE"))
+    return inserted, len(skipped)
+
+
+def import_schedule(db, chat_id, rows):
+    def save(conn):
+        for day, trash_types in rows:
+            trash_bot._save_trash_types(conn, chat_id, day, trash_types)
+    db.run_sync(save)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa prenotazioni passate o il calendario della raccolta.")
+    parser.add_argument("tipo", choices=("prenotazioni", "calendario"))
+    parser.add_argument("file", help=".csv, .json o .ndjson, anche compresso .gz")
+    parser.add_argument("--chat-id", type=int, required=True, help="gruppo a cui appartengono i dati")
+    args = parser.parse_args()
+
+    parse_record = parse_booking if args.tipo == "prenotazioni" else parse_schedule
+    start = time.perf_counter()
+    try:
+        rows = _validate(read_records(args.file), parse_record)
+    except InvalidFile as error:
+        print(f"File non valido, nessun dato importato ({error}):", file=sys.stderr)
+        print("\n".join(error.errors), file=sys.stderr)
+        sys.exit(1)
+    except (OSError, ValueError) as error:
+        print(f"Impossibile leggere {args.file}: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    db = trash_bot.db
+    db.open()
+    db.migrate(MIGRATIONS)
+    try:
+        if args.tipo == "prenotazioni":
+            imported, skipped = import_bookings(db, args.chat_id, rows)
+            print(f"Importate {imported} prenotazioni nuove su {len(rows)} righe in {time.perf_counter() - start:.1f}s")
+            if skipped:
+                print(f"Scartate {skipped} righe già riassunte dall'archiviazione notturna (vedi RETENTION_WEEKS)")
+        else:
+            imported = import_schedule(db, args.chat_id, rows)
+            print(f"Calendario aggiornato per {imported} giorni")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
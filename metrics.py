@@ -0,0 +1,200 @@
+"""Metriche interne del bot: tempi degli handler, delle query e delle chiamate alla Bot API.
+
+Tutto resta in memoria in istogrammi a bucket fissi, esposti in formato testo Prometheus
+(``Metrics.prometheus``, servito da ``serve_prometheus``) o come riepilogo leggibile per
+il comando /metriche. Gli handler e le chiamate alla Bot API vengono registrati dal thread
+dell'event loop, le query dal thread del database: ogni serie ha un solo scrittore.
+"""
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Limiti superiori dei bucket, in secondi
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Istogramma cumulativo con bucket fissi, come quelli di Prometheus."""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Stima del quantile ``q``: il limite superiore del bucket che lo contiene."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def cumulative(self):
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS, self.counts):
+            seen += bucket_count
+            yield str(bound), seen
+        yield "+Inf", self.count
+
+
+class Metrics:
+    """Registro delle metriche del processo."""
+
+    def __init__(self, slow_query_seconds):
+        self.slow_query_seconds = slow_query_seconds
+        self.handlers = {}  # nome dell'handler → Histogram
+        self.handler_errors = {}  # nome dell'handler → numero di eccezioni
+        self.queries = {}  # funzione chiamante → Histogram
+        self.api_calls = {}  # metodo della Bot API → Histogram
+        self.api_errors = {}  # metodo della Bot API → numero di errori
+
+    def _histogram(self, series, key):
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        return histogram
+
+    def observe_handler(self, name, seconds, failed):
+        self._histogram(self.handlers, name).observe(seconds)
+        if failed:
+            self.handler_errors[name] = self.handler_errors.get(name, 0) + 1
+
+    def observe_query(self, caller, operation, seconds):
+        """Hook per ``Database``: registra un'operazione sul database e segnala quelle lente."""
+        self._histogram(self.queries, caller).observe(seconds)
+        if seconds >= self.slow_query_seconds:
+            logger.warning("Query lenta in %s: %.1f ms - %s", caller, seconds * 1000, " ".join(operation.split()))
+
+    def observe_api(self, method, seconds, failed):
+        self._histogram(self.api_calls, method).observe(seconds)
+        if failed:
+            self.api_errors[method] = self.api_errors.get(method, 0) + 1
+
+    def handler(self, callback):
+        """Decoratore per gli handler di python-telegram-bot: ne misura durata ed errori."""
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        async def timed(update, context):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = await callback(update, context)
+                failed = False
+                return result
+            finally:
+                self.observe_handler(name, time.perf_counter() - start, failed)
+
+        return timed
+
+    # Esposizione
+    def prometheus(self):
+        """Tutte le metriche nel formato testo di Prometheus."""
+        lines = []
+        for metric, label, series, description in (
+            ("trashbot_handler_seconds", "handler", self.handlers, "Durata degli handler"),
+            ("trashbot_db_seconds", "caller", self.queries, "Durata delle operazioni sul database per funzione chiamante"),
+            ("trashbot_api_seconds", "method", self.api_calls, "Durata delle chiamate alla Bot API"),
+        ):
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, histogram in sorted(series.items()):
+                for bound, seen in histogram.cumulative():
+                    lines.append(f'{metric}_bucket{{{label}="{key}",le="{bound}"}} {seen}')
+                lines.append(f'{metric}_sum{{{label}="{key}"}} {histogram.total}')
+                lines.append(f'{metric}_count{{{label}="{key}"}} {histogram.count}')
+        for metric, label, counters, description in (
+            ("trashbot_handler_errors_total", "handler", self.handler_errors, "Eccezioni sollevate dagli handler"),
+            ("trashbot_api_errors_total", "method", self.api_errors, "Chiamate alla Bot API fallite"),
+        ):
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in sorted(counters.items()):
+                lines.append(f'{metric}{{{label}="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, limit=10):
+        """Riepilogo testuale per /metriche: le voci con più tempo totale per ogni categoria."""
+        sections = []
+        for title, series, errors in (
+            ("Handler", self.handlers, self.handler_errors),
+            ("Database", self.queries, {}),
+            ("Bot API", self.api_calls, self.api_errors),
+        ):
+            lines = [f"{title}:"]
+            ranked = sorted(series.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+            for key, histogram in ranked:
+                line = (f"  {key}: {histogram.count}x, media {histogram.total / histogram.count * 1000:.1f} ms, "
+                        f"p95 ≤ {histogram.quantile(0.95) * 1000:g} ms")
+                if errors.get(key):
+                    line += f", errori {errors[key]}"
+                lines.append(line)
+            if not ranked:
+                lines.append("  nessun dato")
+            sections.append("\n".join(lines))
+        return "\n\n".join(sections)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """``HTTPXRequest`` che misura la latenza di ogni chiamata alla Bot API."""
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = metrics
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        start = time.perf_counter()
+        failed = True
+        try:
+            status, payload = await super().do_request(url, method, request_data, read_timeout, write_timeout,
+                                                       connect_timeout, pool_timeout)
+            failed = status >= 400
+            return status, payload
+        finally:
+            self._metrics.observe_api(url.rsplit("/", 1)[-1], time.perf_counter() - start, failed)
+
+
+def serve_prometheus(metrics, host, port):
+    """Espone ``/metrics`` in formato Prometheus su un thread in background."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            payload = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="trashbot-metrics", daemon=True).start()
+    logger.info("Metriche Prometheus su http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,148 @@
+"""Persistenza su SQLite degli stati delle conversazioni e di ``context.user_data``.
+
+python-telegram-bot tiene tutto in memoria e ogni ``update_interval`` secondi (e allo
+spegnimento) passa alla persistenza solo le voci toccate. Qui le voci di un giro vengono
+raccolte e scritte in un'unica transazione, saltando quelle uguali all'ultima scrittura:
+un riavvio non perde le conversazioni in corso e i singoli update non scrivono su disco.
+"""
+import asyncio
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+def _save(conn, conversations, user_data):
+    for (name, key), state in conversations.items():
+        if state is None:
+            conn.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+        else:
+            conn.execute('''
+                INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+                ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+            ''', (name, key, state))
+    for user_id, data in user_data.items():
+        if data is None:
+            conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+        else:
+            conn.execute('''
+                INSERT INTO user_data (user_id, data) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET data = excluded.data
+            ''', (user_id, data))
+
+
+class SQLitePersistence(BasePersistence):
+    """``BasePersistence`` per conversazioni e user_data, salvati in JSON nel database del bot.
+
+    La persistenza viene caricata da ``Application.initialize`` prima di ``post_init``:
+    per questo apre il database e applica le migrazioni mancanti al primo accesso.
+    """
+
+    def __init__(self, database, migrations, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._db = database
+        self._migrations = migrations
+        self._conversations = None  # nome → {chiave: stato}, letto una volta all'avvio
+        self._written = {}  # (nome, chiave) o user_id → ultimo JSON scritto
+        self._dirty_conversations = {}  # (nome, chiave JSON) → stato JSON, None per cancellare
+        self._dirty_users = {}  # user_id → dati JSON, None per cancellare
+        self._write_task = None
+
+    async def _load(self):
+        if self._conversations is not None:
+            return
+        self._db.open()
+        self._db.migrate(self._migrations)
+        self._conversations = {}
+        for name, key, state in await self._db.fetchall('SELECT name, key, state FROM conversations'):
+            self._conversations.setdefault(name, {})[tuple(json.loads(key))] = json.loads(state)
+            self._written[(name, key)] = state
+
+    # Caricamento
+    async def get_user_data(self):
+        await self._load()
+        rows = await self._db.fetchall('SELECT user_id, data FROM user_data')
+        self._written.update(rows)
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        await self._load()
+        return dict(self._conversations.get(name, {}))
+
+    # Scrittura a blocchi
+    async def _write_batch(self):
+        """Attende che tutti gli update_* dello stesso giro siano stati raccolti e li scrive insieme."""
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write())
+        await asyncio.shield(self._write_task)
+
+    async def _write(self):
+        # update_persistence lancia gli update_* con asyncio.gather: dopo un giro del loop ci sono tutti
+        await asyncio.sleep(0)
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        user_data, self._dirty_users = self._dirty_users, {}
+        self._write_task = None
+        if conversations or user_data:
+            await self._db.transaction(_save, conversations, user_data)
+
+    def _stage(self, dirty, key, value):
+        if self._written.get(key) == value:
+            return False
+        dirty[key] = value
+        self._written[key] = value
+        return True
+
+    async def update_conversation(self, name, key, new_state):
+        key = json.dumps(key)
+        state = None if new_state is None else json.dumps(new_state)
+        if self._stage(self._dirty_conversations, (name, key), state):
+            await self._write_batch()
+
+    async def update_user_data(self, user_id, data):
+        # Quasi tutti gli utenti hanno user_data vuoto: non serve una riga per loro
+        value = json.dumps(data, sort_keys=True) if data else None
+        if self._stage(self._dirty_users, user_id, value):
+            await self._write_batch()
+
+    async def drop_user_data(self, user_id):
+        if self._stage(self._dirty_users, user_id, None):
+            await self._write_batch()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Allo spegnimento: scrive quanto è rimasto in sospeso."""
+        if self._write_task is not None:
+            await self._write_task
+        if self._dirty_conversations or self._dirty_users:
+            await self._write()
@@ -0,0 +1,366 @@
+"""Migrazioni dello schema del database.
+
+Ogni funzione porta lo schema alla versione successiva (vedi ``db.apply_migrations``):
+per modificare lo schema si aggiunge una nuova funzione in fondo a ``MIGRATIONS``,
+senza mai toccare quelle già distribuite.
+"""
+import os
+
+# Calendario della raccolta usato per un database nuovo
+DEFAULT_SCHEDULE = {
+    0: "Indifferenziato",
+    1: "Organico",
+    2: "Carta",
+    3: "Organico",
+    4: "Vetro, Organico, Plastica",
+}
+
+BOOKING_TABLES = ("trash_bookings", "coffee_bookings")
+
+# Colonna della classifica incrementata da ciascuna tabella di prenotazioni
+LEADERBOARD_COUNTERS = {
+    "trash_bookings": "trash_count",
+    "coffee_bookings": "coffee_count",
+}
+
+
+def create_tables(conn):
+    """Versione 1: tabelle originali (idempotente, per i database creati prima del versioning)."""
+    # Tabella per i tipi di spazzatura per ogni giorno
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS trash_schedule (
+        day_of_week INTEGER PRIMARY KEY,
+        trash_types TEXT
+    )
+    ''')
+    
+    # Tabelle per le prenotazioni della spazzatura e della macchina del caffè
+    for table in BOOKING_TABLES:
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_date DATE,
+            user_id INTEGER,
+            user_name TEXT
+        )
+        ''')
+    
+    # Inizializza il calendario della spazzatura se vuoto
+    conn.executemany('INSERT OR IGNORE INTO trash_schedule VALUES (?, ?)', DEFAULT_SCHEDULE.items())
+
+
+def add_booking_indexes(conn):
+    """Versione 2: indici univoci su (booking_date, user_id) e indice secondario per utente."""
+    for table in BOOKING_TABLES:
+        # Rimuove eventuali doppioni inseriti prima che il vincolo esistesse
+        conn.execute(f'''
+        DELETE FROM {table}
+        WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY booking_date, user_id)
+        ''')
+        # L'indice univoco guida anche le ricerche per sola data
+        conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_date_user ON {table} (booking_date, user_id)')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table} (user_id, booking_date)')
+
+
+def create_leaderboard(conn):
+    """Versione 3: contatori per utente della classifica, aggiornati insieme alle prenotazioni."""
+    conn.execute('''
+    CREATE TABLE leaderboard (
+        user_id INTEGER PRIMARY KEY,
+        user_name TEXT,
+        trash_count INTEGER NOT NULL DEFAULT 0,
+        coffee_count INTEGER NOT NULL DEFAULT 0,
+        total INTEGER GENERATED ALWAYS AS (trash_count + coffee_count) STORED
+    )
+    ''')
+    conn.execute('CREATE INDEX idx_leaderboard_total ON leaderboard (total DESC)')
+    conn.execute('''
+    INSERT INTO leaderboard (user_id, user_name, trash_count, coffee_count)
+    SELECT
+        counts.user_id,
+        COALESCE(
+            (SELECT user_name FROM trash_bookings WHERE user_id = counts.user_id ORDER BY id DESC LIMIT 1),
+            (SELECT user_name FROM coffee_bookings WHERE user_id = counts.user_id ORDER BY id DESC LIMIT 1)
+        ),
+        SUM(counts.trash_count),
+        SUM(counts.coffee_count)
+    FROM (
+        SELECT user_id, COUNT(*) AS trash_count, 0 AS coffee_count FROM trash_bookings GROUP BY user_id
+        UNION ALL
+        SELECT user_id, 0 AS trash_count, COUNT(*) AS coffee_count FROM coffee_bookings GROUP BY user_id
+    ) AS counts
+    GROUP BY counts.user_id
+    ''')
+
+
+def create_users(conn):
+    """Versione 4: tabella users; le prenotazioni e la classifica tengono solo lo user_id."""
+    conn.execute('''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        user_name TEXT NOT NULL
+    )
+    ''')
+    # La classifica contiene già l'ultimo nome noto di ogni utente con prenotazioni
+    conn.execute('''
+    INSERT INTO users (user_id, user_name)
+    SELECT user_id, COALESCE(user_name, CAST(user_id AS TEXT)) FROM leaderboard
+    ''')
+    conn.execute('ALTER TABLE leaderboard DROP COLUMN user_name')
+    
+    # Ricrea le tabelle delle prenotazioni senza la colonna user_name
+    for table in BOOKING_TABLES:
+        conn.execute(f'DROP INDEX idx_{table}_date_user')
+        conn.execute(f'DROP INDEX idx_{table}_user')
+        conn.execute(f'''
+        CREATE TABLE {table}_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_date DATE NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (user_id)
+        )
+        ''')
+        conn.execute(f'''
+        INSERT INTO {table}_new (id, booking_date, user_id)
+        SELECT id, booking_date, user_id FROM {table}
+        WHERE booking_date IS NOT NULL AND user_id IS NOT NULL
+        ''')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        conn.execute(f'CREATE UNIQUE INDEX idx_{table}_date_user ON {table} (booking_date, user_id)')
+        conn.execute(f'CREATE INDEX idx_{table}_user ON {table} (user_id, booking_date)')
+
+
+def partition_by_chat(conn):
+    """Versione 5: calendario, prenotazioni e classifica separati per chat_id.
+
+    I dati esistenti vengono assegnati alla chat indicata dalla variabile ``LEGACY_CHAT_ID``,
+    letta qui e non all'import perché il .env viene caricato dopo; gli indici iniziano tutti
+    con chat_id, così le query di un gruppo non dipendono dalla mole di dati degli altri.
+    Se ci sono prenotazioni, contatori o un calendario modificato e la variabile manca, la
+    migrazione si ferma: i dati finirebbero in una chat inesistente senza che il gruppo
+    se ne accorga, e la migrazione non si può ripetere.
+    """
+    legacy_chat_id = os.getenv("LEGACY_CHAT_ID")
+    if legacy_chat_id is None:
+        has_data = conn.execute('''
+        SELECT EXISTS (SELECT 1 FROM trash_bookings)
+            OR EXISTS (SELECT 1 FROM coffee_bookings)
+            OR EXISTS (SELECT 1 FROM leaderboard WHERE total > 0)
+        ''').fetchone()[0]
+        schedule = dict(conn.execute('SELECT day_of_week, trash_types FROM trash_schedule WHERE trash_types IS NOT NULL'))
+        if has_data or schedule != DEFAULT_SCHEDULE:
+            raise RuntimeError(
+                "Il database contiene dati creati prima della gestione di più gruppi: impostare LEGACY_CHAT_ID "
+                "con l'id del gruppo a cui appartengono (es. LEGACY_CHAT_ID=-1001234567890) e riavviare"
+            )
+        legacy_chat_id = 0  # Database nuovo: il calendario predefinito non appartiene a nessun gruppo
+    legacy_chat_id = int(legacy_chat_id)
+    conn.execute('''
+    CREATE TABLE trash_schedule_new (
+        chat_id INTEGER NOT NULL,
+        day_of_week INTEGER NOT NULL,
+        trash_types TEXT NOT NULL,
+        PRIMARY KEY (chat_id, day_of_week)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    INSERT INTO trash_schedule_new (chat_id, day_of_week, trash_types)
+    SELECT ?, day_of_week, trash_types FROM trash_schedule WHERE trash_types IS NOT NULL
+    ''', (legacy_chat_id,))
+    conn.execute('DROP TABLE trash_schedule')
+    conn.execute('ALTER TABLE trash_schedule_new RENAME TO trash_schedule')
+    
+    for table in BOOKING_TABLES:
+        conn.execute(f'DROP INDEX idx_{table}_date_user')
+        conn.execute(f'DROP INDEX idx_{table}_user')
+        conn.execute(f'''
+        CREATE TABLE {table}_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            booking_date DATE NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (user_id)
+        )
+        ''')
+        conn.execute(f'''
+        INSERT INTO {table}_new (id, chat_id, booking_date, user_id)
+        SELECT id, ?, booking_date, user_id FROM {table}
+        ''', (legacy_chat_id,))
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        conn.execute(f'CREATE UNIQUE INDEX idx_{table}_chat_date_user ON {table} (chat_id, booking_date, user_id)')
+        conn.execute(f'CREATE INDEX idx_{table}_chat_user ON {table} (chat_id, user_id, booking_date)')
+    
+    conn.execute('''
+    CREATE TABLE leaderboard_new (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        trash_count INTEGER NOT NULL DEFAULT 0,
+        coffee_count INTEGER NOT NULL DEFAULT 0,
+        total INTEGER GENERATED ALWAYS AS (trash_count + coffee_count) STORED,
+        PRIMARY KEY (chat_id, user_id)
+    )
+    ''')
+    conn.execute('''
+    INSERT INTO leaderboard_new (chat_id, user_id, trash_count, coffee_count)
+    SELECT ?, user_id, trash_count, coffee_count FROM leaderboard
+    ''', (legacy_chat_id,))
+    conn.execute('DROP TABLE leaderboard')
+    conn.execute('ALTER TABLE leaderboard_new RENAME TO leaderboard')
+    conn.execute('CREATE INDEX idx_leaderboard_chat_total ON leaderboard (chat_id, total DESC)')
+
+
+def create_bot_state(conn):
+    """Versione 6: coppie chiave/valore sullo stato del bot da conservare tra un avvio e l'altro."""
+    conn.execute('''
+    CREATE TABLE bot_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    ) WITHOUT ROWID
+    ''')
+
+
+
+def create_boards(conn):
+    """Versione 7: messaggio della bacheca fissa di ogni chat che l'ha attivata."""
+    conn.execute('''
+    CREATE TABLE boards (
+        chat_id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL
+    )
+    ''')
+
+
+def create_monthly_bookings(conn):
+    """Versione 8: riepilogo mensile per utente delle prenotazioni archiviate."""
+    conn.execute('''
+    CREATE TABLE monthly_bookings (
+        chat_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (user_id),
+        trash_count INTEGER NOT NULL DEFAULT 0,
+        coffee_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, month, user_id)
+    ) WITHOUT ROWID
+    ''')
+
+
+def create_persistence(conn):
+    """Versione 9: stati delle conversazioni e user_data salvati da ``SQLitePersistence``."""
+    conn.execute('''
+    CREATE TABLE conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    )
+    ''')
+
+
+def create_weekly_rollups(conn):
+    """Versione 10: conteggi settimanali per giorno e per utente, da cui si calcolano le statistiche.
+
+    Le prenotazioni già archiviate nei riepiloghi mensili non hanno più il giorno e restano fuori.
+    """
+    conn.execute('''
+    CREATE TABLE weekly_day_counts (
+        chat_id INTEGER NOT NULL,
+        week TEXT NOT NULL,
+        weekday INTEGER NOT NULL,
+        trash_count INTEGER NOT NULL DEFAULT 0,
+        coffee_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, week, weekday)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE weekly_user_counts (
+        chat_id INTEGER NOT NULL,
+        week TEXT NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (user_id),
+        trash_count INTEGER NOT NULL DEFAULT 0,
+        coffee_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, week, user_id)
+    ) WITHOUT ROWID
+    ''')
+    bookings = '''
+    SELECT chat_id, user_id,
+        date(booking_date, '-' || ((CAST(strftime('%w', booking_date) AS INTEGER) + 6) % 7) || ' days') AS week,
+        (CAST(strftime('%w', booking_date) AS INTEGER) + 6) % 7 AS weekday,
+        trash, coffee
+    FROM (
+        SELECT chat_id, booking_date, user_id, 1 AS trash, 0 AS coffee FROM trash_bookings
+        UNION ALL
+        SELECT chat_id, booking_date, user_id, 0 AS trash, 1 AS coffee FROM coffee_bookings
+    )
+    '''
+    conn.execute(f'''
+    INSERT INTO weekly_day_counts (chat_id, week, weekday, trash_count, coffee_count)
+    SELECT chat_id, week, weekday, SUM(trash), SUM(coffee) FROM ({bookings}) GROUP BY chat_id, week, weekday
+    ''')
+    conn.execute(f'''
+    INSERT INTO weekly_user_counts (chat_id, week, user_id, trash_count, coffee_count)
+    SELECT chat_id, week, user_id, SUM(trash), SUM(coffee) FROM ({bookings}) GROUP BY chat_id, week, user_id
+    ''')
+
+
+MIGRATIONS = [
+    create_tables,
+    add_booking_indexes,
+    create_leaderboard,
+    create_users,
+    partition_by_chat,
+    create_bot_state,
+    create_boards,
+    create_monthly_bookings,
+    create_persistence,
+    create_weekly_rollups,
+]
+
+
+def rebuild_leaderboard(conn, chat_id):
+    """Ricalcola da zero i contatori della classifica di una chat dalle prenotazioni e dai riepiloghi mensili."""
+    conn.execute('DELETE FROM leaderboard WHERE chat_id = ?', (chat_id,))
+    conn.execute('''
+    INSERT INTO leaderboard (chat_id, user_id, trash_count, coffee_count)
+    SELECT ?, user_id, SUM(trash_count), SUM(coffee_count)
+    FROM (
+        SELECT user_id, COUNT(*) AS trash_count, 0 AS coffee_count FROM trash_bookings WHERE chat_id = ? GROUP BY user_id
+        UNION ALL
+        SELECT user_id, 0 AS trash_count, COUNT(*) AS coffee_count FROM coffee_bookings WHERE chat_id = ? GROUP BY user_id
+        UNION ALL
+        SELECT user_id, trash_count, coffee_count FROM monthly_bookings WHERE chat_id = ?
+    )
+    GROUP BY user_id
+    ''', (chat_id, chat_id, chat_id, chat_id))
+
+
+def archive_bookings(conn, cutoff):
+    """Sposta le prenotazioni precedenti a ``cutoff`` (ISO) nei riepiloghi mensili e restituisce quante erano.
+
+    La classifica non cambia: i suoi contatori non dipendono dalle righe rimaste. La data
+    limite più recente resta in ``bot_state`` alla voce ``archive_cutoff``.
+    """
+    conn.execute('''
+    INSERT INTO monthly_bookings (chat_id, month, user_id, trash_count, coffee_count)
+    SELECT chat_id, substr(booking_date, 1, 7), user_id, SUM(trash), SUM(coffee)
+    FROM (
+        SELECT chat_id, booking_date, user_id, 1 AS trash, 0 AS coffee FROM trash_bookings WHERE booking_date < ?
+        UNION ALL
+        SELECT chat_id, booking_date, user_id, 0 AS trash, 1 AS coffee FROM coffee_bookings WHERE booking_date < ?
+    )
+    GROUP BY chat_id, substr(booking_date, 1, 7), user_id
+    ON CONFLICT (chat_id, month, user_id) DO UPDATE SET
+        trash_count = trash_count + excluded.trash_count,
+        coffee_count = coffee_count + excluded.coffee_count
+    ''', (cutoff, cutoff))
+    # L'importatore usa la data limite per non reinserire prenotazioni già riassunte
+    conn.execute('''
+    INSERT INTO bot_state (key, value) VALUES ('archive_cutoff', ?)
+    ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)
+    ''', (cutoff,))
+    return sum(conn.execute(f'DELETE FROM {table} WHERE booking_date < ?', (cutoff,)).rowcount for table in BOOKING_TABLES)
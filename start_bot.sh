@@ -4,4 +4,5 @@ source .env
 
 conda activate trashbot
 
-pm2 start trash_bot.py --name trashbot --interpreter python -f
+# --kill-timeout lascia al bot il tempo di chiudere webhook/polling e database dopo SIGINT
+pm2 start trash_bot.py --name trashbot --interpreter python -f --kill-timeout 10000
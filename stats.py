@@ -0,0 +1,118 @@
+"""Statistiche delle prenotazioni, calcolate dai riepiloghi settimanali.
+
+``weekly_day_counts`` (chat, settimana, giorno) e ``weekly_user_counts`` (chat, settimana,
+utente) vengono aggiornati nella stessa transazione di ogni prenotazione o cancellazione.
+Le statistiche leggono solo le settimane della finestra richiesta, per chiave primaria:
+il tempo di risposta non dipende da quanta storia c'è nel database.
+"""
+from datetime import date, timedelta
+
+# Settimane considerate da /statistiche, compresa quella corrente
+STATS_WEEKS = 12
+
+# Mesi mostrati nel riepilogo mensile, compreso quello corrente
+STATS_MONTHS = 6
+
+# Espressioni SQL per il lunedì della settimana e l'indice del giorno (0 = lunedì) di una data ISO
+WEEKDAY_SQL = "((CAST(strftime('%w', booking_date) AS INTEGER) + 6) % 7)"
+WEEK_SQL = f"date(booking_date, '-' || {WEEKDAY_SQL} || ' days')"
+
+
+def week_of(day):
+    """Lunedì della settimana di ``day``."""
+    return day - timedelta(days=day.weekday())
+
+
+def count_booking(conn, counter, chat_id, day, user_id, delta):
+    """Aggiunge ``delta`` alla colonna ``counter`` dei riepiloghi settimanali per una prenotazione."""
+    week = week_of(day).isoformat()
+    conn.execute(f'''
+        INSERT INTO weekly_day_counts (chat_id, week, weekday, {counter}) VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat_id, week, weekday) DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''', (chat_id, week, day.weekday(), delta))
+    conn.execute(f'''
+        INSERT INTO weekly_user_counts (chat_id, week, user_id, {counter}) VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat_id, week, user_id) DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''', (chat_id, week, user_id, delta))
+
+
+def count_bookings_from(conn, counter, chat_id, source, where="1", params=()):
+    """Come ``count_booking``, ma per tutte le righe (booking_date, user_id) di ``source`` in due query aggregate."""
+    conn.execute(f'''
+        INSERT INTO weekly_day_counts (chat_id, week, weekday, {counter})
+        SELECT ?, {WEEK_SQL}, {WEEKDAY_SQL}, COUNT(*) FROM {source} WHERE {where}
+        GROUP BY 2, 3
+        ON CONFLICT (chat_id, week, weekday) DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''', (chat_id, *params))
+    conn.execute(f'''
+        INSERT INTO weekly_user_counts (chat_id, week, user_id, {counter})
+        SELECT ?, {WEEK_SQL}, user_id, COUNT(*) FROM {source} WHERE {where}
+        GROUP BY 2, 3
+        ON CONFLICT (chat_id, week, user_id) DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''', (chat_id, *params))
+
+
+def gini(values):
+    """Indice di Gini dei valori: 0 se sono tutti uguali, vicino a 1 se uno solo ha tutto."""
+    values = sorted(values)
+    total = sum(values)
+    if not values or not total:
+        return 0.0
+    n = len(values)
+    weighted = sum(rank * value for rank, value in enumerate(values, start=1))
+    return 2 * weighted / (n * total) - (n + 1) / n
+
+
+def load_statistics(conn, chat_id, today):
+    """Legge dai riepiloghi i dati di /statistiche per la chat, nella finestra che termina con la settimana di ``today``.
+
+    Le prenotazioni per le settimane successive restano fuori; quelle della settimana corrente
+    compaiono solo nei conteggi per settimana e per mese, non in copertura ed equità.
+    """
+    this_monday = week_of(today)
+    first_week = this_monday - timedelta(weeks=STATS_WEEKS - 1)
+    month_start = today.replace(day=1)
+    for _ in range(STATS_MONTHS - 1):
+        month_start = (month_start - timedelta(days=1)).replace(day=1)
+
+    weekly = conn.execute('''
+        SELECT week, SUM(trash_count), SUM(coffee_count) FROM weekly_day_counts
+        WHERE chat_id = ? AND week BETWEEN ? AND ?
+        GROUP BY week ORDER BY week
+    ''', (chat_id, first_week.isoformat(), this_monday.isoformat())).fetchall()
+
+    monthly = conn.execute('''
+        SELECT strftime('%Y-%m', week, '+' || weekday || ' days') AS month, SUM(trash_count), SUM(coffee_count)
+        FROM weekly_day_counts
+        WHERE chat_id = ? AND week BETWEEN ? AND ?
+        GROUP BY month HAVING month >= ? ORDER BY month
+    ''', (chat_id, week_of(month_start).isoformat(), this_monday.isoformat(), month_start.strftime('%Y-%m'))).fetchall()
+
+    # Copertura: solo settimane già concluse, dalla prima attività della chat in poi
+    first_activity = conn.execute('SELECT MIN(week) FROM weekly_day_counts WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+    coverage_start = max(first_week.isoformat(), first_activity or this_monday.isoformat())
+    # Una chat con prenotazioni solo per le prossime settimane non ha ancora settimane concluse
+    covered_weeks = max(0, (this_monday - date.fromisoformat(coverage_start)).days // 7)
+    coverage = {
+        weekday: (trash_weeks, coffee_weeks)
+        for weekday, trash_weeks, coffee_weeks in conn.execute('''
+            SELECT weekday, SUM(trash_count > 0), SUM(coffee_count > 0) FROM weekly_day_counts
+            WHERE chat_id = ? AND week >= ? AND week < ?
+            GROUP BY weekday
+        ''', (chat_id, coverage_start, this_monday.isoformat()))
+    }
+
+    # Equità: come la copertura, solo settimane concluse (i turni prenotati per i prossimi giorni non sono ancora svolti)
+    per_user = conn.execute('''
+        SELECT user_id, SUM(trash_count + coffee_count) AS total FROM weekly_user_counts
+        WHERE chat_id = ? AND week >= ? AND week < ?
+        GROUP BY user_id HAVING total > 0 ORDER BY total DESC
+    ''', (chat_id, first_week.isoformat(), this_monday.isoformat())).fetchall()
+
+    return {
+        "weekly": weekly,
+        "monthly": monthly,
+        "covered_weeks": covered_weeks,
+        "coverage": coverage,
+        "per_user": per_user,
+    }
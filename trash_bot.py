@@ -1,11 +1,24 @@
 import os
 import logging
-import sqlite3
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, ChatMemberAdministrator, ChatMemberOwner
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler
+import hashlib
+import json
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, Chat, ChatMemberAdministrator, ChatMemberOwner
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import AIORateLimiter, ApplicationBuilder, ChatMemberHandler, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler, TypeHandler
 from dotenv import load_dotenv
 import re
+import secrets
+from board import BoardDebouncer
+from cache import AdminCache, KeyboardCache, RenderCache, ScheduleCache, UserDirectory
+from concurrency import PerChatUpdateProcessor
+from db import Database
+from export import iter_bookings, parse_export_args, write_export
+from persistence import SQLitePersistence
+from metrics import InstrumentedRequest, Metrics, serve_prometheus
+from schema import DEFAULT_SCHEDULE, LEADERBOARD_COUNTERS, MIGRATIONS, archive_bookings, rebuild_leaderboard
+from stats import STATS_WEEKS, count_booking, gini, load_statistics, week_of
 
 # Configurazione logging
 logging.basicConfig(
@@ -16,6 +29,67 @@ load_dotenv()
 # Token del bot (da inserire)
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") 
 
+# Endpoint della Bot API (modificabile per puntare a un server locale di test)
+API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+
+# Modalità webhook: attiva solo se WEBHOOK_URL è impostato, altrimenti si usa il polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Token che Telegram rimanda in ogni richiesta; se manca ne viene generato uno a ogni avvio
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# Limiti di invio verso Telegram (0 = disattivato); oltre i limiti le chiamate restano in coda
+# e un RetryAfter di Telegram viene atteso e ritentato fino a SEND_MAX_RETRIES volte
+SEND_RATE_PER_SECOND = float(os.getenv("SEND_RATE_PER_SECOND", "30"))
+SEND_RATE_PER_GROUP_PER_MINUTE = float(os.getenv("SEND_RATE_PER_GROUP_PER_MINUTE", "20"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Secondi tra un salvataggio e l'altro di conversazioni in corso e user_data (sempre anche allo spegnimento)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "30"))
+
+# Update elaborati in parallelo (sempre in ordine per lo stesso utente nella stessa chat)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+# Settimane di prenotazioni tenute riga per riga: quelle più vecchie vengono riassunte
+# per mese e utente da un job notturno (0 = nessuna archiviazione)
+RETENTION_WEEKS = int(os.getenv("RETENTION_WEEKS", "8"))
+
+# Metriche di handler, query e chiamate alla Bot API; le query più lente di SLOW_QUERY_MS finiscono nel log
+metrics = Metrics(float(os.getenv("SLOW_QUERY_MS", "100")) / 1000)
+
+# Endpoint Prometheus facoltativo (/metrics), attivo solo se METRICS_PORT è impostato
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# Connessione persistente al database, servita da un thread dedicato
+# Prenotazioni e cancellazioni arrivate entro DB_BATCH_WINDOW_MS millisecondi condividono un solo commit:
+# vale per utenti diversi, anche dello stesso gruppo, mentre i clic di uno stesso utente restano in sequenza
+db = Database(
+    os.getenv("TRASH_BOT_DB", "trash_scheduler.db"),
+    on_query=metrics.observe_query,
+    batch_window=float(os.getenv("DB_BATCH_WINDOW_MS", "2")) / 1000,
+)
+
+# Calendari della raccolta di ogni chat tenuti in memoria (cambiano solo con /configura)
+schedule = ScheduleCache(DEFAULT_SCHEDULE)
+
+# Nomi degli utenti per user_id, specchio della tabella users
+users = UserDirectory()
+
+# Amministratori di ogni gruppo, riletti da Telegram al massimo ogni ADMIN_CACHE_TTL secondi
+admins = AdminCache(int(os.getenv("ADMIN_CACHE_TTL", "600")))
+
+# Messaggi di /visualizza e /calendario già formattati, invalidati a ogni modifica dei dati
+rendered = RenderCache()
+
+# Bacheche fisse delle chat che le hanno attivate con /bacheca: chat_id → message_id
+board_messages = {}
+
+# Prenotazioni mostrate per pagina nella lista di cancellazione
+CANCEL_PAGE_SIZE = 5
+
 # Stati per la conversazione
 SELECTING_DAY = 1
 SELECTING_TASK = 2
@@ -48,94 +122,32 @@ def get_giorno_indice(nome):
 
 # Inizializzazione del database SQLite
 def init_db():
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    
-    # Tabella per i tipi di spazzatura per ogni giorno
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS trash_schedule (
-        day_of_week INTEGER PRIMARY KEY,
-        trash_types TEXT
-    )
-    ''')
-    
-    # Tabella per le prenotazioni della spazzatura
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS trash_bookings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        booking_date DATE,
-        user_id INTEGER,
-        user_name TEXT
-    )
-    ''')
-    
-    # Tabella per le prenotazioni della macchina del caffè
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS coffee_bookings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        booking_date DATE,
-        user_id INTEGER,
-        user_name TEXT
-    )
-    ''')
-    
-    # Inizializza il calendario della spazzatura se vuoto
-    cursor.execute('SELECT COUNT(*) FROM trash_schedule')
-    if cursor.fetchone()[0] == 0:
-        default_schedule = {
-            0: "Indifferenziato",
-            1: "Organico",
-            2: "Carta",
-            3: "Organico",
-            4: "Vetro, Organico, Plastica",
-        }
-        for day, trash_types in default_schedule.items():
-            cursor.execute('INSERT INTO trash_schedule VALUES (?, ?)', (day, trash_types))
-    
-    conn.commit()
-    conn.close()
-
-
-def get_leaderboard():
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    
-    # Unisce le prenotazioni di spazzatura e caffè, raggruppando per utente
-    cursor.execute('''
-        SELECT 
-            user_name,
-            SUM(trash_count) AS total_trash,
-            SUM(coffee_count) AS total_coffee,
-            (SUM(trash_count) + SUM(coffee_count)) AS total
-        FROM (
-            SELECT 
-                user_name, 
-                COUNT(*) AS trash_count,
-                0 AS coffee_count
-            FROM trash_bookings
-            GROUP BY user_name
-            
-            UNION ALL
-            
-            SELECT 
-                user_name, 
-                0 AS trash_count,
-                COUNT(*) AS coffee_count
-            FROM coffee_bookings
-            GROUP BY user_name
-        )
-        GROUP BY user_name
+    db.open()
+    db.migrate(MIGRATIONS)
+    schedule.load(db.run_sync(lambda conn: conn.execute('SELECT chat_id, day_of_week, trash_types FROM trash_schedule').fetchall()))
+    users.load(db.run_sync(lambda conn: conn.execute('SELECT user_id, user_name FROM users').fetchall()))
+    board_messages.update(db.run_sync(lambda conn: conn.execute('SELECT chat_id, message_id FROM boards').fetchall()))
+
+
+async def close_db(application) -> None:
+    db.close()
+
+
+async def get_leaderboard(chat_id):
+    # I contatori per utente sono aggiornati a ogni prenotazione o cancellazione
+    rows = await db.fetchall('''
+        SELECT user_id, trash_count, coffee_count, total
+        FROM leaderboard
+        WHERE chat_id = ? AND total > 0
         ORDER BY total DESC
         LIMIT 10
-    ''')
-    
-    leaderboard = cursor.fetchall()
-    conn.close()
-    return leaderboard
+    ''', (chat_id,))
+    return [(users.name(user_id), *counts) for user_id, *counts in rows]
 
+@metrics.handler
 async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Mostra la classifica delle persone che hanno portato giù la spazzatura e pulito il caffè più volte."""
-    leaderboard = get_leaderboard()
+    leaderboard = await get_leaderboard(update.effective_chat.id)
     
     if not leaderboard:
         await update.message.reply_text("🏆 Nessuna prenotazione trovata! Sii il primo a prenotarti per portare giù la spazzatura o pulire la macchina del caffè!")
@@ -151,99 +163,187 @@ async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text(message, parse_mode="Markdown")
 
 
+@metrics.handler
+async def statistics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mostra prenotazioni per settimana e per mese, i giorni spesso scoperti e quanto sono distribuiti i turni."""
+    today = date.today()
+    chat_id = update.effective_chat.id
+    message = await rendered.get_or_render(chat_id, ("statistiche", today), render_statistics, chat_id, today)
+    await update.message.reply_text(message, parse_mode="Markdown")
+
+async def render_statistics(chat_id, today):
+    """Costruisce il messaggio di /statistiche dai riepiloghi settimanali."""
+    stats = await db.run(load_statistics, chat_id, today, operation="load_statistics")
+    if not stats["weekly"]:
+        return "📊 Nessuna prenotazione nelle ultime settimane."
+    
+    message = f"📊 *Statistiche delle ultime {STATS_WEEKS} settimane:*\n\n"
+    
+    message += "*Prenotazioni per settimana:*\n"
+    this_monday = week_of(today).isoformat()
+    for week, trash_count, coffee_count in stats["weekly"]:
+        week_display = date.fromisoformat(week).strftime('%d/%m')
+        ongoing = " (in corso)" if week == this_monday else ""
+        message += f"• {week_display}: 🗑️ {trash_count}  ☕ {coffee_count}{ongoing}\n"
+    
+    message += "\n*Prenotazioni per mese:*\n"
+    for month, trash_count, coffee_count in stats["monthly"]:
+        message += f"• {month}: 🗑️ {trash_count}  ☕ {coffee_count}\n"
+    
+    # Un giorno è scoperto quando in meno di metà delle settimane concluse qualcuno si è prenotato
+    covered_weeks = stats["covered_weeks"]
+    if covered_weeks > 0:
+        message += f"\n*Copertura per giorno* (settimane con almeno un prenotato su {covered_weeks}):\n"
+        for day_idx, day_name in enumerate(GIORNI_NOMI):
+            trash_weeks, coffee_weeks = stats["coverage"].get(day_idx, (0, 0))
+            line = f"🗑️ {trash_weeks}/{covered_weeks}"
+            uncovered = trash_weeks * 2 < covered_weeks
+            if isCoffeeDay(day_idx):
+                line += f"  ☕ {coffee_weeks}/{covered_weeks}"
+                uncovered = uncovered or coffee_weeks * 2 < covered_weeks
+            message += f"• {day_name}: {line}{' ⚠️' if uncovered else ''}\n"
+        message += "⚠️ = spesso senza nessuno\n"
+    
+    per_user = stats["per_user"]
+    if per_user:
+        totals = [total for _, total in per_user]
+        mean = sum(totals) / len(totals)
+        message += f"\n*Equità* (settimane concluse): {len(totals)} persone, da {totals[-1]} a {totals[0]} turni a testa "
+        message += f"(media {mean:.1f}), indice di Gini {gini(totals):.2f} (0 = turni divisi alla pari)\n"
+        most = ", ".join(f"{escape_markdown_basic(users.name(user_id))} ({total})" for user_id, total in per_user[:3])
+        message += f"Più presenti: {most}\n"
+        if len(per_user) > 3:
+            least = ", ".join(f"{escape_markdown_basic(users.name(user_id))} ({total})" for user_id, total in per_user[-3:])
+            message += f"Meno presenti: {least}\n"
+    
+    return message
+
+
 # Funzioni per il database
-def get_trash_types(day_of_week):
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT trash_types FROM trash_schedule WHERE day_of_week = ?', (day_of_week,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else "Nessuna raccolta"
-
-def set_trash_types(day_of_week, trash_types):
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE trash_schedule SET trash_types = ? WHERE day_of_week = ?', (trash_types, day_of_week))
-    conn.commit()
-    conn.close()
-
-def add_trash_booking(booking_date, user_id, user_name):
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    
-    # Controlla se l'utente è già prenotato per questa data
-    cursor.execute('SELECT id FROM trash_bookings WHERE booking_date = ? AND user_id = ?', (booking_date, user_id))
-    if cursor.fetchone():
-        conn.close()
-        return False  # L'utente è già prenotato per questa data
-    
-    # Aggiunge la prenotazione con la data specifica
-    cursor.execute('INSERT INTO trash_bookings (booking_date, user_id, user_name) VALUES (?, ?, ?)',
-                  (booking_date, user_id, user_name))
-    conn.commit()
-    conn.close()
-    return True
+def get_trash_types(chat_id, day_of_week):
+    return schedule.get(chat_id, day_of_week)
 
+def _save_trash_types(conn, chat_id, day_of_week, trash_types):
+    # Alla prima modifica la chat riceve il calendario predefinito
+    conn.executemany('INSERT OR IGNORE INTO trash_schedule (chat_id, day_of_week, trash_types) VALUES (?, ?, ?)',
+                     [(chat_id, day, types) for day, types in DEFAULT_SCHEDULE.items()])
+    conn.execute('''
+        INSERT INTO trash_schedule (chat_id, day_of_week, trash_types) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id, day_of_week) DO UPDATE SET trash_types = excluded.trash_types
+    ''', (chat_id, day_of_week, trash_types))
 
-def add_coffee_booking(booking_date, user_id, user_name):
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    
-    # Controlla se l'utente è già prenotato per questa data
-    cursor.execute('SELECT id FROM coffee_bookings WHERE booking_date = ? AND user_id = ?', (booking_date, user_id))
-    if cursor.fetchone():
-        conn.close()
+async def set_trash_types(chat_id, day_of_week, trash_types):
+    await db.transaction(_save_trash_types, chat_id, day_of_week, trash_types)
+    schedule.set(chat_id, day_of_week, trash_types)
+    rendered.invalidate(chat_id)
+
+def format_user_name(user):
+    """Nome visualizzato di un utente Telegram, es. "Mario Rossi (@mrossi)"."""
+    return f"{user.first_name} {user.last_name if user.last_name else ''} (@{user.username})" if user.username else f"{user.first_name} {user.last_name if user.last_name else ''}"
+
+def _save_user(conn, user_id, user_name):
+    # Scrive solo se l'utente è nuovo o ha cambiato nome
+    conn.execute('''
+        INSERT INTO users (user_id, user_name) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name
+        WHERE user_name != excluded.user_name
+    ''', (user_id, user_name))
+
+def _add_booking(conn, table, chat_id, booking_date, user_id, user_name):
+    _save_user(conn, user_id, user_name)
+    
+    # Un solo statement atomico: se l'utente è già prenotato per questa data il vincolo
+    # univoco su (chat_id, booking_date, user_id) scarta l'inserimento
+    cursor = conn.execute(f'''
+        INSERT INTO {table} (chat_id, booking_date, user_id) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id, booking_date, user_id) DO NOTHING
+    ''', (chat_id, booking_date, user_id))
+    if cursor.rowcount == 0:
         return False  # L'utente è già prenotato per questa data
     
-    # Aggiunge la prenotazione con la data specifica
-    cursor.execute('INSERT INTO coffee_bookings (booking_date, user_id, user_name) VALUES (?, ?, ?)',
-                  (booking_date, user_id, user_name))
-    conn.commit()
-    conn.close()
+    # Aggiorna la classifica nella stessa transazione
+    counter = LEADERBOARD_COUNTERS[table]
+    conn.execute(f'''
+        INSERT INTO leaderboard (chat_id, user_id, {counter}) VALUES (?, ?, 1)
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET {counter} = {counter} + 1
+    ''', (chat_id, user_id))
+    count_booking(conn, counter, chat_id, date.fromisoformat(booking_date), user_id, 1)
     return True
 
+def _delete_booking(conn, table, chat_id, booking_date, user_id):
+    cursor = conn.execute(f'DELETE FROM {table} WHERE chat_id = ? AND user_id = ? AND booking_date = ?',
+                          (chat_id, user_id, booking_date))
+    if cursor.rowcount == 0:
+        return False
+    
+    counter = LEADERBOARD_COUNTERS[table]
+    conn.execute(f'UPDATE leaderboard SET {counter} = {counter} - 1 WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+    count_booking(conn, counter, chat_id, date.fromisoformat(booking_date), user_id, -1)
+    return True
+
+@metrics.handler
+async def remember_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Registra o aggiorna il nome di chi interagisce con il bot (scrive solo se è cambiato)."""
+    user = update.effective_user
+    if user is None:
+        return
+    user_name = format_user_name(user)
+    if not users.is_current(user.id, user_name):
+        await db.transaction(_save_user, user.id, user_name)
+        users.set(user.id, user_name)
+        rendered.invalidate()
+
+
+def _booking_saved(success, chat_id, user_id, user_name):
+    if not users.is_current(user_id, user_name):
+        users.set(user_id, user_name)
+        rendered.invalidate()  # Il nome compare nei messaggi di tutte le chat
+    elif success:
+        rendered.invalidate(chat_id)
+
+
+async def add_trash_booking(chat_id, booking_date, user_id, user_name):
+    success = await db.batched(_add_booking, "trash_bookings", chat_id, booking_date, user_id, user_name)
+    _booking_saved(success, chat_id, user_id, user_name)
+    return success
 
-def get_trash_bookings():
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT booking_date, user_name FROM trash_bookings ORDER BY booking_date')
-    bookings = {}
-    for date, user_name in cursor.fetchall():
-        # La data è già nel formato YYYY-MM-DD, la convertiamo solo per la visualizzazione
-        display_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d/%m/%Y')
-        if display_date not in bookings:
-            bookings[display_date] = []
-        bookings[display_date].append(user_name)
-    conn.close()
-    return bookings
 
+async def add_coffee_booking(chat_id, booking_date, user_id, user_name):
+    success = await db.batched(_add_booking, "coffee_bookings", chat_id, booking_date, user_id, user_name)
+    _booking_saved(success, chat_id, user_id, user_name)
+    return success
 
-def get_coffee_bookings():
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT booking_date, user_name FROM coffee_bookings ORDER BY booking_date')
-    bookings = {}
-    for date, user_name in cursor.fetchall():
-        # La data è già nel formato YYYY-MM-DD, la convertiamo solo per la visualizzazione
-        display_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d/%m/%Y')
-        if display_date not in bookings:
-            bookings[display_date] = []
-        bookings[display_date].append(user_name)
-    conn.close()
+
+async def remove_booking(table, chat_id, booking_date, user_id):
+    success = await db.batched(_delete_booking, table, chat_id, booking_date, user_id)
+    if success:
+        rendered.invalidate(chat_id)
+    return success
+
+
+async def get_bookings_between(chat_id, start, end):
+    """Restituisce le prenotazioni della chat con data in [start, end) come {"trash": {data: [utenti]}, "coffee": {...}}."""
+    rows = await db.fetchall('''
+        SELECT 'trash', booking_date, user_id FROM trash_bookings
+        WHERE chat_id = ? AND booking_date >= ? AND booking_date < ?
+        UNION ALL
+        SELECT 'coffee', booking_date, user_id FROM coffee_bookings
+        WHERE chat_id = ? AND booking_date >= ? AND booking_date < ?
+    ''', (chat_id, start.isoformat(), end.isoformat()) * 2)
+    bookings = {"trash": {}, "coffee": {}}
+    for booking_type, booking_date, user_id in rows:
+        bookings[booking_type].setdefault(date.fromisoformat(booking_date), []).append(users.name(user_id))
     return bookings
 
-def get_all_trash_types():
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT day_of_week, trash_types FROM trash_schedule ORDER BY day_of_week')
-    schedule = {day: types for day, types in cursor.fetchall()}
-    conn.close()
-    return schedule
+def get_all_trash_types(chat_id):
+    return schedule.all(chat_id)
 
+@metrics.handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Invia un messaggio di benvenuto quando viene emesso il comando /start."""
     await help_command(update, context)
 
+@metrics.handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Invia un messaggio di aiuto quando viene emesso il comando /aiuto."""
     await update.message.reply_text(
@@ -255,15 +355,19 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/calendario - Visualizza il calendario della raccolta differenziata e le prenotazioni rimanenti\n"
         "/configura - Configura i tipi di spazzatura per ogni giorno (solo amministratori)\n"
         "/leaderboard - Mostra la classifica di chi ha portato giù la spazzatura e pulito il caffè\n"
+        "/ricalcola - Ricalcola la classifica dalle prenotazioni (solo amministratori)\n"
+        "/statistiche - Prenotazioni per settimana e per mese, giorni spesso scoperti e distribuzione dei turni\n"
+        "/bacheca - Fissa un messaggio con le prenotazioni che si aggiorna da solo; /bacheca off per toglierlo (solo amministratori)\n"
+        "/esporta - Esporta le prenotazioni in CSV o NDJSON, es. /esporta ndjson gz caffe dal 2025-01-01 (solo amministratori)\n"
+        "/metriche - Mostra i tempi di risposta del bot (solo amministratori)\n"
         "/aiuto - Mostra questo messaggio di aiuto",
         parse_mode="Markdown"
     )
 
 
-async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Gestisce il comando /prenota e mostra i giorni disponibili da oggi fino alla fine della settimana prossima."""
+def build_trash_keyboard(chat_id, today):
+    """Tastiera di /prenota: i giorni da oggi fino alla fine della settimana prossima."""
     keyboard = []
-    today = datetime.now()
     current_weekday = today.weekday()  # 0 = Lunedì, ..., 6 = Domenica
     
     # 1. Mostra i giorni rimanenti di questa settimana (da oggi a Venerdì)
@@ -271,7 +375,7 @@ async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         day = today + timedelta(days=(day_idx - current_weekday))
         day_name = GIORNI_NOMI[day_idx]
         day_date = day_name + day.strftime(" %d/%m")  # es. "Mercoledì 25/02"
-        trash_types = get_trash_types(day_idx)
+        trash_types = get_trash_types(chat_id, day_idx)
         keyboard.append([InlineKeyboardButton(
             f"{day_date} - {trash_types}", 
             callback_data=f"book_trash_{day.strftime('%Y-%m-%d')}"
@@ -283,22 +387,18 @@ async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         next_day = next_monday + timedelta(days=day_idx)
         day_name = GIORNI_NOMI[day_idx]
         day_date = day_name + next_day.strftime(" %d/%m")  # es. "Lunedì 03/03"
-        trash_types = get_trash_types(day_idx)
+        trash_types = get_trash_types(chat_id, day_idx)
         keyboard.append([InlineKeyboardButton(
             f"{day_date} - {trash_types}", 
             callback_data=f"book_trash_{next_day.strftime('%Y-%m-%d')}"
         )])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Seleziona un giorno per prenotarti a portare la spazzatura:", reply_markup=reply_markup)
-    return SELECTING_DAY
+    return InlineKeyboardMarkup(keyboard)
 
 
-
-async def coffee_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Gestisce il comando /caffe e mostra i giorni disponibili da oggi fino alla fine della settimana prossima."""
+def build_coffee_keyboard(chat_id, today):
+    """Tastiera di /caffe: i martedì e giovedì da oggi fino alla fine della settimana prossima."""
     keyboard = []
-    today = datetime.now()
     current_weekday = today.weekday()  # 0 = Lunedì, ..., 6 = Domenica
     
     # 1. Mostra i giorni rimanenti di questa settimana (da oggi a Venerdì)
@@ -322,18 +422,54 @@ async def coffee_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             callback_data=f"book_coffee_{next_day.strftime('%Y-%m-%d')}"
         )])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Tastiere di prenotazione, ricostruite solo quando cambia il giorno o il calendario
+keyboards = KeyboardCache({"trash": build_trash_keyboard, "coffee": build_coffee_keyboard})
+
+
+async def refresh_keyboards(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job di mezzanotte: prepara le tastiere del nuovo giorno prima della prima richiesta."""
+    keyboards.warm(date.today(), schedule.version)
+
+
+async def apply_retention(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job notturno: archivia le prenotazioni più vecchie di RETENTION_WEEKS settimane e compatta il database."""
+    cutoff = (date.today() - timedelta(weeks=RETENTION_WEEKS)).isoformat()
+    archived = await db.transaction(archive_bookings, cutoff)
+    if archived:
+        logging.info("Archiviate %d prenotazioni precedenti al %s", archived, cutoff)
+        await db.vacuum()
+
+
+@metrics.handler
+async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Gestisce il comando /prenota e mostra i giorni disponibili da oggi fino alla fine della settimana prossima."""
+    chat_id = update.effective_chat.id
+    reply_markup = keyboards.get("trash", chat_id, date.today(), schedule.version(chat_id))
+    await update.message.reply_text("Seleziona un giorno per prenotarti a portare la spazzatura:", reply_markup=reply_markup)
+    return SELECTING_DAY
+
+
+@metrics.handler
+async def coffee_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Gestisce il comando /caffe e mostra i giorni disponibili da oggi fino alla fine della settimana prossima."""
+    chat_id = update.effective_chat.id
+    reply_markup = keyboards.get("coffee", chat_id, date.today(), schedule.version(chat_id))
     await update.message.reply_text("Seleziona un giorno per prenotarti a pulire la macchina del caffè:", reply_markup=reply_markup)
     return SELECTING_COFFEE_DAY
 
 
+@metrics.handler
 async def handle_booking(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Gestisce la selezione del giorno per la prenotazione e mostra le prenotazioni aggiornate."""
     query = update.callback_query
     await query.answer()
     
+    chat_id = update.effective_chat.id
     user = query.from_user
-    user_info = f"{user.first_name} {user.last_name if user.last_name else ''} (@{user.username})" if user.username else f"{user.first_name} {user.last_name if user.last_name else ''}"
+    user_info = format_user_name(user)
     
     callback_data = query.data.split("_")
     booking_type = callback_data[1]  # trash o coffee
@@ -359,18 +495,20 @@ async def handle_booking(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     }[day_name]
     
     if booking_type == "trash":
-        success = add_trash_booking(booking_date, user.id, user_info)
-        trash_types = get_trash_types(datetime.strptime(booking_date, '%Y-%m-%d').weekday())
+        success = await add_trash_booking(chat_id, booking_date, user.id, user_info)
+        trash_types = get_trash_types(chat_id, datetime.strptime(booking_date, '%Y-%m-%d').weekday())
         
         if success:
+            touch_board(chat_id, context.bot)
             message = f"Hai prenotato per portare la spazzatura il *{day_name_italian} {booking_date}*!\nTipo di rifiuti da raccogliere: {trash_types}"
         else:
             message = f"⚠️ Sei già prenotato per portare la spazzatura il *{day_name_italian} {booking_date}*!"
     
     elif booking_type == "coffee":
-        success = add_coffee_booking(booking_date, user.id, user_info)
+        success = await add_coffee_booking(chat_id, booking_date, user.id, user_info)
         
         if success:
+            touch_board(chat_id, context.bot)
             message = f"Hai prenotato per pulire la macchina del caffè il *{day_name_italian} {booking_date}*!"
         else:
             message = f"⚠️ Sei già prenotato per pulire la macchina del caffè il *{day_name_italian} {booking_date}*!"
@@ -378,20 +516,17 @@ async def handle_booking(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         message = "❌ Si è verificato un errore. Riprova."
     
-    # Mostra la conferma della prenotazione
-    await query.edit_message_text(message, parse_mode="Markdown")
-    
-    # Mostra le prenotazioni aggiornate per la data selezionata
-    trash_bookings = get_trash_bookings_for_date(booking_date)
-    coffee_bookings = get_coffee_bookings_for_date(booking_date)
+    # Conferma e prenotazioni aggiornate per la data selezionata in un'unica modifica del messaggio
+    trash_bookings = await get_trash_bookings_for_date(chat_id, booking_date)
+    coffee_bookings = await get_coffee_bookings_for_date(chat_id, booking_date)
     
-    booking_message = f"📅 *Prenotazioni per {day_name_italian} {booking_date}:*\n\n"
+    booking_message = f"{message}\n\n📅 *Prenotazioni per {day_name_italian} {booking_date}:*\n\n"
     
     # Prenotazioni per la spazzatura
     booking_message += "🗑️ *Spazzatura:*\n"
     if trash_bookings:
         for user in trash_bookings:
-            booking_message += f"• {user}\n"
+            booking_message += f"• {escape_markdown_basic(user)}\n"
     else:
         booking_message += "• -\n"
     
@@ -399,44 +534,48 @@ async def handle_booking(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     booking_message += "\n☕ *Macchina del Caffè:*\n"
     if coffee_bookings:
         for user in coffee_bookings:
-            booking_message += f"• {user}\n"
+            booking_message += f"• {escape_markdown_basic(user)}\n"
     else:
         booking_message += "• -\n"
     
-    await query.message.reply_text(booking_message, parse_mode="Markdown")
+    await query.edit_message_text(booking_message, parse_mode="Markdown")
     return ConversationHandler.END
 
 
-def get_trash_bookings_for_date(booking_date):
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_name FROM trash_bookings WHERE booking_date = ? ORDER BY user_name', (booking_date,))
-    bookings = [user_name[0] for user_name in cursor.fetchall()]
-    conn.close()
-    return bookings
+async def get_trash_bookings_for_date(chat_id, booking_date):
+    rows = await db.fetchall('SELECT user_id FROM trash_bookings WHERE chat_id = ? AND booking_date = ?', (chat_id, booking_date))
+    return sorted(users.name(user_id) for user_id, in rows)
 
 
-def get_coffee_bookings_for_date(booking_date):
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_name FROM coffee_bookings WHERE booking_date = ? ORDER BY user_name', (booking_date,))
-    bookings = [user_name[0] for user_name in cursor.fetchall()]
-    conn.close()
-    return bookings
+async def get_coffee_bookings_for_date(chat_id, booking_date):
+    rows = await db.fetchall('SELECT user_id FROM coffee_bookings WHERE chat_id = ? AND booking_date = ?', (chat_id, booking_date))
+    return sorted(users.name(user_id) for user_id, in rows)
 
 def escape_markdown_basic(text: str) -> str:
     """Escape solo i caratteri speciali per il Markdown normale (_ e *)."""
     return re.sub(r'([_*])', r'\\\1', text)
 
 
+@metrics.handler
 async def view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Visualizza le prenotazioni della settimana corrente e della settimana prossima."""
-    today = datetime.now()
-    trash_bookings = get_trash_bookings()
-    coffee_bookings = get_coffee_bookings()
-    trash_schedule = get_all_trash_types()
+    today = date.today()
+    chat_id = update.effective_chat.id
+    message = await rendered.get_or_render(chat_id, ("visualizza", today), render_bookings, chat_id, today)
     
+    # **Mandiamo il messaggio con Markdown normale**
+    await update.message.reply_text(message, parse_mode="Markdown")
+
+async def render_bookings(chat_id, today):
+    """Costruisce il messaggio di /visualizza per la data indicata."""
     current_weekday = today.weekday()
+    this_monday = today - timedelta(days=current_weekday)
+    
+    # Legge solo le prenotazioni da oggi fino al venerdì della settimana prossima
+    bookings = await get_bookings_between(chat_id, today, this_monday + timedelta(days=12))
+    trash_bookings = bookings["trash"]
+    coffee_bookings = bookings["coffee"]
+    trash_schedule = get_all_trash_types(chat_id)
     
     message = "📋 *Prenotazioni:*\n\n"
     
@@ -444,9 +583,6 @@ async def view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if current_weekday < 5:
         message += "*🗓️ QUESTA SETTIMANA:*\n\n"
         
-        days_since_monday = current_weekday
-        this_monday = today - timedelta(days=days_since_monday)
-        
         for day_idx in range(current_weekday, 5):
             this_day = this_monday + timedelta(days=day_idx)
             booking_date_display = escape_markdown_basic(this_day.strftime('%d/%m/%Y'))
@@ -459,8 +595,8 @@ async def view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             
             # Prenotazioni spazzatura
             message += "*Prenotati per la spazzatura:*\n"
-            if booking_date_display in trash_bookings:
-                for user in trash_bookings[booking_date_display]:
+            if this_day in trash_bookings:
+                for user in trash_bookings[this_day]:
                     message += f"• {escape_markdown_basic(user)}\n"
             else:
                 message += "• -\n"
@@ -468,8 +604,8 @@ async def view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             # Prenotazioni macchina caffè, solo se il giorno da stampare è martedì o giovedì
             if isCoffeeDay(day_idx):
                 message += "*Prenotati per la macchina del caffè:*\n"
-                if booking_date_display in coffee_bookings:
-                    for user in coffee_bookings[booking_date_display]:
+                if this_day in coffee_bookings:
+                    for user in coffee_bookings[this_day]:
                         message += f"• {escape_markdown_basic(user)}\n"
                 else:
                     message += "• -\n"
@@ -481,10 +617,7 @@ async def view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     # Parte 2: Prenotazioni della settimana prossima
     message += "*🗓️ SETTIMANA PROSSIMA:*\n\n"
     
-    days_to_next_monday = (7 - today.weekday()) % 7
-    if days_to_next_monday == 0:
-        days_to_next_monday = 7
-    next_monday = today + timedelta(days=days_to_next_monday)
+    next_monday = this_monday + timedelta(days=7)
     
     for day_idx in range(5):
         next_day = next_monday + timedelta(days=day_idx)
@@ -497,25 +630,25 @@ async def view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         message += f"*Spazzatura:* {trash_types}\n"
         
         message += "*Prenotati per la spazzatura:*\n"
-        if booking_date_display in trash_bookings:
-            for user in trash_bookings[booking_date_display]:
+        if next_day in trash_bookings:
+            for user in trash_bookings[next_day]:
                 message += f"• {escape_markdown_basic(user)}\n"
         else:
             message += "• -\n"
         
         if isCoffeeDay(day_idx):
             message += "*Prenotati per la macchina del caffè:*\n"
-            if booking_date_display in coffee_bookings:
-                for user in coffee_bookings[booking_date_display]:
+            if next_day in coffee_bookings:
+                for user in coffee_bookings[next_day]:
                     message += f"• {escape_markdown_basic(user)}\n"
             else:
                 message += "• -\n"
             
         message += "\n"
     
-    # **Mandiamo il messaggio con Markdown normale**
-    await update.message.reply_text(message, parse_mode="Markdown")
+    return message
 
+@metrics.handler
 async def cancel_booking_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Permette all'utente di scegliere il tipo di prenotazione da cancellare."""
     keyboard = [
@@ -526,43 +659,78 @@ async def cancel_booking_command(update: Update, context: ContextTypes.DEFAULT_T
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Che tipo di prenotazione vuoi cancellare?", reply_markup=reply_markup)
 
+async def get_future_bookings_page(table, chat_id, user_id, today, after=None, before=None):
+    """Una pagina di prenotazioni dell'utente da ``today`` in poi, in ordine di data.
+
+    Paginazione keyset sull'indice (chat_id, user_id, booking_date): la pagina segue ``after``
+    oppure precede ``before``. Restituisce le date e se ce ne sono altre in quella direzione.
+    """
+    if before is None:
+        rows = await db.fetchall(f'''
+            SELECT booking_date FROM {table}
+            WHERE chat_id = ? AND user_id = ? AND booking_date >= ? AND booking_date > ?
+            ORDER BY booking_date
+            LIMIT ?
+        ''', (chat_id, user_id, today, after or "", CANCEL_PAGE_SIZE + 1))
+        dates = [booking_date for booking_date, in rows[:CANCEL_PAGE_SIZE]]
+    else:
+        rows = await db.fetchall(f'''
+            SELECT booking_date FROM {table}
+            WHERE chat_id = ? AND user_id = ? AND booking_date >= ? AND booking_date < ?
+            ORDER BY booking_date DESC
+            LIMIT ?
+        ''', (chat_id, user_id, today, before, CANCEL_PAGE_SIZE + 1))
+        dates = [booking_date for booking_date, in reversed(rows[:CANCEL_PAGE_SIZE])]
+    return dates, len(rows) > CANCEL_PAGE_SIZE
+
+@metrics.handler
 async def cancel_booking_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Mostra le prenotazioni dell'utente per il tipo scelto e permette di cancellarle."""
+    """Mostra una pagina delle prenotazioni future dell'utente per il tipo scelto e permette di cancellarle."""
     query = update.callback_query
     await query.answer()
+    chat_id = update.effective_chat.id
     user_id = query.from_user.id
-    booking_type = query.data  # "cancel_trash" o "cancel_coffee"
+    # "cancel_trash" / "cancel_coffee", con le pagine successive "..._after_<data>" e precedenti "..._before_<data>"
+    _, booking_type, *cursor = query.data.split("_")
+    direction, cursor_date = cursor if cursor else ("after", None)
 
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-
-    if booking_type == "cancel_trash":
-        cursor.execute('SELECT booking_date FROM trash_bookings WHERE user_id = ?', (user_id,))
-        bookings = cursor.fetchall()
+    if booking_type == "trash":
+        table = "trash_bookings"
         booking_label = "spazzatura"
         callback_prefix = "delete_trash_"
     else:
-        cursor.execute('SELECT booking_date FROM coffee_bookings WHERE user_id = ?', (user_id,))
-        bookings = cursor.fetchall()
+        table = "coffee_bookings"
         booking_label = "macchina del caffè"
         callback_prefix = "delete_coffee_"
 
-    conn.close()
+    today = date.today().isoformat()
+    if direction == "before":
+        bookings, has_previous = await get_future_bookings_page(table, chat_id, user_id, today, before=cursor_date)
+        has_next = True
+    else:
+        bookings, has_next = await get_future_bookings_page(table, chat_id, user_id, today, after=cursor_date)
+        has_previous = cursor_date is not None
 
     if not bookings:
         keyboard = [[InlineKeyboardButton("🔙 Indietro", callback_data="go_back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(f"Non hai prenotazioni per la {booking_label} da cancellare.", reply_markup=reply_markup)
+        await query.message.edit_text(f"Non hai prenotazioni future per la {booking_label} da cancellare.", reply_markup=reply_markup)
         return
 
-    # Ordina le prenotazioni dalla più recente alla più lontana
-    sorted_bookings = sorted(bookings, key=lambda x: datetime.strptime(x[0], "%Y-%m-%d"), reverse=True)
-
+    # Prenotazioni dalla più vicina alla più lontana
     keyboard = [
-        [InlineKeyboardButton(f"Cancella {booking[0]}", callback_data=f"{callback_prefix}{booking[0]}")]
-        for booking in sorted_bookings
+        [InlineKeyboardButton(f"Cancella {booking_date}", callback_data=f"{callback_prefix}{booking_date}")]
+        for booking_date in bookings
     ]
     
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton("◀️ Precedenti", callback_data=f"cancel_{booking_type}_before_{bookings[0]}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Successive ▶️", callback_data=f"cancel_{booking_type}_after_{bookings[-1]}"))
+    if navigation:
+        keyboard.append(navigation)
+    
     # Aggiunge il tasto "Indietro"
     keyboard.append([InlineKeyboardButton("🔙 Indietro", callback_data="go_back")])
 
@@ -570,10 +738,12 @@ async def cancel_booking_selection(update: Update, context: ContextTypes.DEFAULT
     await query.message.edit_text(f"Seleziona una prenotazione della {booking_label} da cancellare:", reply_markup=reply_markup)
 
 
+@metrics.handler
 async def delete_booking(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Cancella la prenotazione selezionata dall'utente."""
     query = update.callback_query
     await query.answer()
+    chat_id = update.effective_chat.id
     user_id = query.from_user.id
     data = query.data  # Esempio: "delete_trash_2025-02-28" o "delete_coffee_2025-02-28"
     
@@ -588,22 +758,29 @@ async def delete_booking(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         return  # Non dovrebbe mai accadere
 
-    conn = sqlite3.connect('trash_scheduler.db')
-    cursor = conn.cursor()
-    cursor.execute(f'DELETE FROM {table} WHERE user_id = ? AND booking_date = ?', (user_id, booking_date))
-    conn.commit()
-    conn.close()
+    if await remove_booking(table, chat_id, booking_date, user_id):
+        touch_board(chat_id, context.bot)
 
     await query.message.edit_text(f"✅ La prenotazione per la {booking_label} del {booking_date} è stata cancellata con successo.")
 
     
+@metrics.handler
 async def view_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Visualizza il calendario settimanale della raccolta differenziata e le prenotazioni rimanenti per la settimana corrente."""
-    today = datetime.now()
+    today = date.today()
+    chat_id = update.effective_chat.id
+    message = await rendered.get_or_render(chat_id, ("calendario", today), render_schedule, chat_id, today)
+    await update.message.reply_text(message, parse_mode="Markdown")
+
+async def render_schedule(chat_id, today):
+    """Costruisce il messaggio di /calendario per la data indicata."""
     current_weekday = today.weekday()  # 0 = Lunedì, 4 = Venerdì
-    trash_schedule = get_all_trash_types()
-    trash_bookings = get_trash_bookings()
-    coffee_bookings = get_coffee_bookings()
+    trash_schedule = get_all_trash_types(chat_id)
+    
+    # Legge solo le prenotazioni da oggi fino a venerdì
+    bookings = await get_bookings_between(chat_id, today, today + timedelta(days=max(5 - current_weekday, 0)))
+    trash_bookings = bookings["trash"]
+    coffee_bookings = bookings["coffee"]
     
     message = "📅 *Calendario settimanale della raccolta differenziata:*\n\n"
     
@@ -613,26 +790,18 @@ async def view_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         message += f"*{day_name}*: {trash_schedule.get(i, 'Nessuna raccolta')}\n"
     
     message += "\n📌 *Prenotazioni rimanenti per questa settimana:*\n\n"
-    
-    # Trova il lunedì della settimana corrente
-    current_monday = today - timedelta(days=today.weekday())
-    print(f"Lunedì corrente: {current_monday.strftime('%d/%m/%Y')}")
 
     remaining_days = False
     for i in range(current_weekday, 5):  # Dal giorno corrente a venerdì
         next_day = today + timedelta(days=(i - current_weekday))
-
-        booking_date_db = next_day.strftime('%Y-%m-%d')  # Formato per il database
         booking_date_display = next_day.strftime('%d/%m/%Y')  # Formato per l'output
         day_name = GIORNI_NOMI[i]
         
         message += f"*{day_name} {booking_date_display}*\n"
-        print(trash_bookings)
-        print(booking_date_display)
         # Prenotazioni spazzatura
         message += "*Prenotati per la spazzatura:*\n"
-        if booking_date_display in trash_bookings:
-            for user in trash_bookings[booking_date_display]:
+        if next_day in trash_bookings:
+            for user in trash_bookings[next_day]:
                 message += f"• {user}\n"
         else:
             message += "• -\n"
@@ -640,8 +809,8 @@ async def view_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         # Prenotazioni macchina caffè
         if isCoffeeDay(i):
             message += "*Prenotati per la macchina del caffè:*\n"
-            if booking_date_display in coffee_bookings:
-                for user in coffee_bookings[booking_date_display]:
+            if next_day in coffee_bookings:
+                for user in coffee_bookings[next_day]:
                     message += f"• {user}\n"
             else:
                 message += "• -\n"
@@ -652,22 +821,38 @@ async def view_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not remaining_days:
         message += "Non ci sono più giorni lavorativi rimanenti in questa settimana.\n"
     
-    await update.message.reply_text(message, parse_mode="Markdown")
+    return message
 
 # Funzione per verificare se l'utente è un amministratore o il proprietario del gruppo
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
-    # Recupera i dettagli dell'utente nella chat
-    member = await context.bot.get_chat_member(chat_id, user_id)
+    # Le chat private non hanno amministratori: si controlla direttamente l'utente
+    if update.effective_chat.type == Chat.PRIVATE:
+        member = await context.bot.get_chat_member(chat_id, user_id)
+        return isinstance(member, (ChatMemberAdministrator, ChatMemberOwner))
+    
+    # Nei gruppi la lista degli amministratori viene letta in blocco e tenuta in cache
+    chat_admins = admins.get(chat_id)
+    if chat_admins is None:
+        members = await context.bot.get_chat_administrators(chat_id)
+        chat_admins = {member.user.id for member in members}
+        admins.put(chat_id, chat_admins)
     
     # Controlla se l'utente è un amministratore o il proprietario del gruppo
-    if isinstance(member, (ChatMemberAdministrator, ChatMemberOwner)):
-        return True
-    return False
+    return user_id in chat_admins
+
+@metrics.handler
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Aggiorna la cache degli amministratori quando qualcuno viene promosso o rimosso."""
+    change = update.chat_member or update.my_chat_member
+    member = change.new_chat_member
+    is_now_admin = isinstance(member, (ChatMemberAdministrator, ChatMemberOwner))
+    admins.update(change.chat.id, member.user.id, is_now_admin)
 
 # Modifica della funzione configure_command per includere il controllo amministratore
+@metrics.handler
 async def configure_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Gestisce il comando /configura e mostra i giorni disponibili SOLO per gli amministratori."""
     
@@ -678,10 +863,11 @@ async def configure_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
     
     # Se l'utente è un amministratore, continua con la configurazione
+    chat_id = update.effective_chat.id
     keyboard = []
     for i in range(5):  # 0 = Lunedì, 4 = Venerdì
         day_name = GIORNI_NOMI[i]
-        trash_types = get_trash_types(i)
+        trash_types = get_trash_types(chat_id, i)
         keyboard.append([InlineKeyboardButton(
             f"{day_name} - {trash_types}", 
             callback_data=f"config_{i}"
@@ -691,6 +877,7 @@ async def configure_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("Seleziona un giorno per configurare i tipi di spazzatura:", reply_markup=reply_markup)
     return CONFIGURING_TRASH
 
+@metrics.handler
 async def handle_day_config(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Gestisce la selezione del giorno per la configurazione."""
     query = update.callback_query
@@ -700,7 +887,7 @@ async def handle_day_config(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data["config_day"] = selected_day
     
     day_name = GIORNI_NOMI[selected_day]
-    current_types = get_trash_types(selected_day)
+    current_types = get_trash_types(update.effective_chat.id, selected_day)
     
     await query.edit_message_text(
         f"Configura i tipi di spazzatura per {day_name}\n"
@@ -710,6 +897,7 @@ async def handle_day_config(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     return ADDING_TRASH_TYPE
 
+@metrics.handler
 async def add_trash_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Aggiunge i tipi di spazzatura per un giorno."""
     if "config_day" not in context.user_data:
@@ -719,33 +907,187 @@ async def add_trash_type(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     day = context.user_data["config_day"]
     trash_types = update.message.text.strip()
     
-    set_trash_types(day, trash_types)
+    await set_trash_types(update.effective_chat.id, day, trash_types)
+    touch_board(update.effective_chat.id, context.bot)
     
     day_name = GIORNI_NOMI[day]
     
     await update.message.reply_text(f"Tipi di spazzatura per {day_name} aggiornati a: {trash_types}")
     return ConversationHandler.END
 
+@metrics.handler
+async def rebuild_leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ricalcola la classifica a partire dalle prenotazioni (solo amministratori)."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("❌ Questo comando è riservato solo agli amministratori.")
+        return
+    
+    await db.transaction(rebuild_leaderboard, update.effective_chat.id)
+    await update.message.reply_text("✅ Classifica ricalcolata.")
+
+@metrics.handler
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mostra dove va il tempo: handler, query e chiamate alla Bot API (solo amministratori)."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("❌ Questo comando è riservato solo agli amministratori.")
+        return
+    
+    await update.message.reply_text(f"📊 Metriche dall'avvio:\n\n{metrics.summary()}")
+
+# Intestazione della bacheca fissa, seguita dal messaggio di /visualizza
+BOARD_HEADER = "📌 *Bacheca prenotazioni* - si aggiorna da sola\n\n"
+
+async def render_board(chat_id):
+    today = date.today()
+    return BOARD_HEADER + await rendered.get_or_render(chat_id, ("visualizza", today), render_bookings, chat_id, today)
+
+async def refresh_board(chat_id, bot):
+    """Riscrive la bacheca della chat con le prenotazioni attuali."""
+    message_id = board_messages.get(chat_id)
+    if message_id is None:
+        return
+    try:
+        await bot.edit_message_text(await render_board(chat_id), chat_id, message_id, parse_mode="Markdown")
+    except BadRequest as error:
+        if "not modified" in error.message:
+            return
+        if "not found" not in error.message:
+            raise
+        # Il messaggio è stato cancellato dalla chat: la bacheca viene disattivata
+        await db.execute('DELETE FROM boards WHERE chat_id = ?', (chat_id,))
+        board_messages.pop(chat_id, None)
+
+# Aggiornamenti delle bacheche raggruppati: una raffica di prenotazioni produce una sola modifica
+boards = BoardDebouncer(float(os.getenv("BOARD_DEBOUNCE_SECONDS", "5")), refresh_board)
+
+def touch_board(chat_id, bot):
+    """Segnala alla bacheca della chat, se attiva, che le prenotazioni sono cambiate."""
+    if chat_id in board_messages:
+        boards.touch(chat_id, bot)
+
+async def refresh_boards(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job di mezzanotte: le bacheche passano al nuovo giorno."""
+    for chat_id in list(board_messages):
+        boards.touch(chat_id, context.bot)
+
+async def flush_boards(application) -> None:
+    await boards.flush()
+
+@metrics.handler
+async def board_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Attiva (/bacheca) o disattiva (/bacheca off) la bacheca fissa delle prenotazioni (solo amministratori)."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("❌ Questo comando è riservato solo agli amministratori.")
+        return
+    
+    chat_id = update.effective_chat.id
+    previous_message_id = board_messages.get(chat_id)
+    
+    if context.args and context.args[0].lower() == "off":
+        if previous_message_id is None:
+            await update.message.reply_text("La bacheca non è attiva in questa chat.")
+            return
+        await db.execute('DELETE FROM boards WHERE chat_id = ?', (chat_id,))
+        board_messages.pop(chat_id, None)
+        try:
+            await context.bot.unpin_chat_message(chat_id, previous_message_id)
+        except TelegramError:
+            pass  # Messaggio già rimosso o permessi revocati
+        await update.message.reply_text("✅ Bacheca disattivata.")
+        return
+    
+    message = await update.message.reply_text(await render_board(chat_id), parse_mode="Markdown")
+    await db.execute('''
+        INSERT INTO boards (chat_id, message_id) VALUES (?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET message_id = excluded.message_id
+    ''', (chat_id, message.message_id))
+    board_messages[chat_id] = message.message_id
+    
+    try:
+        await context.bot.pin_chat_message(chat_id, message.message_id, disable_notification=True)
+        if previous_message_id is not None:
+            await context.bot.unpin_chat_message(chat_id, previous_message_id)
+    except TelegramError:
+        await update.message.reply_text("⚠️ Bacheca attivata, ma non riesco a fissarla: serve il permesso di fissare i messaggi.")
+
+@metrics.handler
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Invia le prenotazioni della chat come file CSV o NDJSON (solo amministratori)."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("❌ Questo comando è riservato solo agli amministratori.")
+        return
+    
+    try:
+        export_format, compress, types, start, end = parse_export_args(context.args)
+    except ValueError as error:
+        await update.message.reply_text(
+            f"❌ {error}\n\n"
+            "Uso: /esporta [csv|ndjson] [gz] [spazzatura|caffe] [dal AAAA-MM-GG] [al AAAA-MM-GG]"
+        )
+        return
+    
+    chat_id = update.effective_chat.id
+    rows = iter_bookings(db, chat_id, types, start, end)
+    export_file, count = await write_export(rows, export_format, compress, users.name)
+    filename = f"prenotazioni_{date.today().isoformat()}.{export_format}" + (".gz" if compress else "")
+    with export_file:
+        await update.message.reply_document(export_file, filename=filename, caption=f"📤 {count} prenotazioni esportate")
+
+@metrics.handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancella la conversazione corrente."""
     await update.message.reply_text("Operazione annullata.")
     return ConversationHandler.END
 
+# Comandi mostrati nel menu di Telegram
+COMMANDS = [
+    BotCommand("start", "Avvia il bot"),
+    BotCommand("prenota", "Prenota un giorno per portare giù la spazzatura"),
+    BotCommand("cancella", "Cancella la tua prenotazione"),
+    BotCommand("visualizza", "Visualizza tutte le prenotazioni"),
+    BotCommand("caffe", "Prenota per la spazzatura"),
+    BotCommand("calendario", "Visualizza il calendario della raccolta differenziata"),
+    BotCommand("configura", "Configura i tipi di spazzatura per ogni giorno"),
+    BotCommand("aiuto", "Mostra questo messaggio di aiuto"),
+    BotCommand("leaderboard", "Mostra la classifica di chi ha portato giù la spazzatura e pulito il caffè"),
+    BotCommand("ricalcola", "Ricalcola la classifica dalle prenotazioni"),
+    BotCommand("statistiche", "Mostra le statistiche delle prenotazioni"),
+    BotCommand("bacheca", "Fissa una bacheca delle prenotazioni sempre aggiornata"),
+    BotCommand("esporta", "Esporta le prenotazioni in un file"),
+    BotCommand("metriche", "Mostra i tempi di risposta del bot"),
+]
+
 async def set_commands(application):
-    commands = [
-        BotCommand("start", "Avvia il bot"),
-        BotCommand("prenota", "Prenota un giorno per portare giù la spazzatura"),
-        BotCommand("cancella", "Cancella la tua prenotazione"),
-        BotCommand("visualizza", "Visualizza tutte le prenotazioni"),
-        BotCommand("caffe", "Prenota per la spazzatura"),
-        BotCommand("calendario", "Visualizza il calendario della raccolta differenziata"),
-        BotCommand("configura", "Configura i tipi di spazzatura per ogni giorno"),
-        BotCommand("aiuto", "Mostra questo messaggio di aiuto"),
-        BotCommand("leaderboard", "Mostra la classifica di chi ha portato giù la spazzatura e pulito il caffè"),
-    ]
+    """Invia a Telegram la lista dei comandi solo se è cambiata dall'ultima volta."""
+    bot = application.bot
+    payload = json.dumps([bot.id, [command.to_dict() for command in COMMANDS]], sort_keys=True)
+    digest = hashlib.sha256(payload.encode()).hexdigest()
+    row = await db.fetchone("SELECT value FROM bot_state WHERE key = 'commands_hash'")
+    if row and row[0] == digest:
+        return
+    
+    try:
+        await bot.set_my_commands(COMMANDS)
+    except TelegramError as error:
+        # Non blocca l'avvio: si riprova al prossimo riavvio
+        logging.warning("Impossibile aggiornare i comandi del bot: %s", error)
+        return
+    await db.execute('''
+        INSERT INTO bot_state (key, value) VALUES ('commands_hash', ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+    ''', (digest,))
+    logging.info("Comandi del bot aggiornati")
+
+async def post_init(application) -> None:
+    """Avvio del bot: migrazioni mancanti, cache in memoria, comandi e tastiere del giorno."""
+    init_db()
+    await set_commands(application)
     
-    await application.bot.set_my_commands(commands)
+    # Prepara le tastiere delle chat già note prima del primo /prenota
+    rows = await db.fetchall('SELECT chat_id FROM leaderboard UNION SELECT chat_id FROM trash_schedule')
+    keyboards.warm(date.today(), schedule.version, [chat_id for chat_id, in rows])
     
+@metrics.handler
 async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Torna alla schermata principale di cancellazione."""
     query = update.callback_query
@@ -759,18 +1101,52 @@ async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.edit_text("Che tipo di prenotazione vuoi cancellare?", reply_markup=reply_markup)
     
+
+def local_timezone():
+    """Fuso orario di sistema come zona IANA (da TZ o /etc/localtime), per seguire l'ora legale.
+
+    ``datetime.now().astimezone().tzinfo`` è solo l'offset del momento dell'avvio: dopo il
+    cambio d'ora i job giornalieri scatterebbero un'ora prima o dopo.
+    """
+    name = os.getenv("TZ", "").lstrip(":")
+    if not name:
+        target = os.path.realpath("/etc/localtime")
+        name = target.split("/zoneinfo/", 1)[1] if "/zoneinfo/" in target else ""
+    if name:
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logging.warning("Fuso orario %s non riconosciuto", name)
+    logging.warning("Fuso orario di sistema non determinabile: i job giornalieri usano l'offset attuale "
+                    "e non seguiranno l'ora legale (impostare TZ, es. TZ=Europe/Rome)")
+    return datetime.now().astimezone().tzinfo
+
 def main() -> None:
     """Avvia il bot."""
-    # Inizializza il database
-    init_db()
-    
-    # Crea l'applicazione
-    application = ApplicationBuilder().token(TOKEN).build()
-    # Imposta i comandi
-    set_commands(application)
+    # Crea l'applicazione; database, cache e comandi vengono preparati in post_init
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .request(InstrumentedRequest(metrics, connection_pool_size=256))
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=SEND_RATE_PER_SECOND,
+            group_max_rate=SEND_RATE_PER_GROUP_PER_MINUTE,
+            max_retries=SEND_MAX_RETRIES,
+        ))
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence(db, MIGRATIONS, update_interval=PERSISTENCE_INTERVAL))
+        .post_init(post_init)
+        .post_stop(flush_boards)
+        .post_shutdown(close_db)
+    )
+    if API_BASE_URL:
+        builder = builder.base_url(f"{API_BASE_URL.rstrip('/')}/bot").base_file_url(f"{API_BASE_URL.rstrip('/')}/file/bot")
+    application = builder.build()
     
     # Crea il conversation handler per la prenotazione spazzatura
     trash_conv_handler = ConversationHandler(
+        name="prenota",
+        persistent=True,
         entry_points=[CommandHandler("prenota", book_command)],
         states={
             SELECTING_DAY: [CallbackQueryHandler(handle_booking, pattern=r"^book_trash_")],
@@ -780,6 +1156,8 @@ def main() -> None:
     
     # Crea il conversation handler per la prenotazione caffè
     coffee_conv_handler = ConversationHandler(
+        name="caffe",
+        persistent=True,
         entry_points=[CommandHandler("caffe", coffee_command)],
         states={
             SELECTING_COFFEE_DAY: [CallbackQueryHandler(handle_booking, pattern=r"^book_coffee_")],
@@ -789,6 +1167,8 @@ def main() -> None:
     
     # Crea il conversation handler per la configurazione
     config_conv_handler = ConversationHandler(
+        name="configura",
+        persistent=True,
         entry_points=[CommandHandler("configura", configure_command)],
         states={
             CONFIGURING_TRASH: [CallbackQueryHandler(handle_day_config, pattern=r"^config_")],
@@ -797,6 +1177,10 @@ def main() -> None:
         fallbacks=[CommandHandler("annulla", cancel)],
     )
     
+    # Tiene aggiornata la tabella users prima di ogni altro handler
+    application.add_handler(TypeHandler(Update, remember_user), group=-1)
+    application.add_handler(ChatMemberHandler(track_admin_changes, ChatMemberHandler.ANY_CHAT_MEMBER))
+    
     application.add_handler(CommandHandler("cancella", cancel_booking_command))
     application.add_handler(CallbackQueryHandler(cancel_booking_selection, pattern="^cancel_"))
     application.add_handler(CallbackQueryHandler(delete_booking, pattern="^delete_"))
@@ -808,12 +1192,43 @@ def main() -> None:
     application.add_handler(CommandHandler("visualizza", view_bookings))
     application.add_handler(CommandHandler("calendario", view_schedule))
     application.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    application.add_handler(CommandHandler("ricalcola", rebuild_leaderboard_command))
+    application.add_handler(CommandHandler("statistiche", statistics_command))
+    application.add_handler(CommandHandler("bacheca", board_command))
+    application.add_handler(CommandHandler("esporta", export_command))
+    application.add_handler(CommandHandler("metriche", metrics_command))
     application.add_handler(trash_conv_handler)
     application.add_handler(coffee_conv_handler)
     application.add_handler(config_conv_handler)
     
-    # Avvia il bot
-    application.run_polling()
+    # Ricostruisce le tastiere di prenotazione allo scoccare del nuovo giorno
+    if application.job_queue:
+        local_midnight = time(0, 0, 1, tzinfo=local_timezone())
+        application.job_queue.run_daily(refresh_keyboards, local_midnight, name="refresh_keyboards")
+        application.job_queue.run_daily(refresh_boards, local_midnight, name="refresh_boards")
+        if RETENTION_WEEKS > 0:
+            night = time(3, 30, tzinfo=local_midnight.tzinfo)
+            application.job_queue.run_daily(apply_retention, night, name="apply_retention")
+    else:
+        logging.warning("JobQueue non disponibile: le tastiere verranno ricostruite alla prima richiesta del giorno "
+                        "e le bacheche alla prima modifica; le prenotazioni vecchie non verranno archiviate")
+    
+    if METRICS_PORT:
+        serve_prometheus(metrics, METRICS_LISTEN, int(METRICS_PORT))
+    
+    # Avvia il bot: entrambe le modalità gestiscono SIGINT/SIGTERM (pm2) chiudendo in modo pulito
+    if WEBHOOK_URL:
+        # Server HTTP integrato; le richieste senza il secret token corretto vengono rifiutate
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,  # Include chat_member per la cache degli amministratori
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file